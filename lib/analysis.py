@@ -0,0 +1,325 @@
+"""Analysis functions
+
+This module contains the functions used to quantify the channels of a
+sample inside its mask.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+analyse_channels
+    Positive area, positive mean, total mean and positive fraction of
+    several channels in a single pass
+analyse_fibers
+    Per-fiber area, mean intensity, integrated intensity and positive
+    fraction of several channels
+fiber_areas
+    Labels and areas of the fibers
+assign_points
+    Fiber label of every point
+fiber_point_counts
+    Per-fiber point counts and densities of several channels
+colocalization
+    Pairwise Pearson correlation and Manders coefficients of several
+    channels in a single streaming pass
+"""
+import time
+import numpy as np
+
+from lib.models.Roi import Roi
+
+# Amount of in-mask pixels gathered at once by colocalization
+CHUNK_SIZE = 1 << 16
+# Version of the results of analyse_channels, part of the keys of the
+# analysis cache (see Sample.analyse)
+VERSION = 2
+
+
+def analyse_channels(images, names, thresholds, mask):
+    """Analyses several channels in a single pass
+
+    The in-mask pixels of the channels are gathered once into a
+    (channels x pixels) array per dtype, which is thresholded and reduced
+    for all its channels at once. Every channel keeps its own dtype, so the
+    results don't depend on the other channels analysed with it and are
+    the same as Channel.analyse.
+
+    Parameters
+    ----------
+    images
+        List of channel images
+    names
+        List of channel names
+    thresholds
+        List of channel thresholds
+    mask
+        Boolean mask or Roi. With a Roi, pixels are gathered from the
+        bounding box only
+
+    Returns
+    -------
+        List of dicts with the same keys as Channel.analyse, one per channel,
+        and a dict with the time (s) spent in every stage
+    """
+
+    timings = {"Gather": 0.0, "Threshold": 0.0, "Reduce": 0.0}
+    if len(images) == 0:
+        return [], timings
+
+    if not isinstance(mask, Roi):
+        mask = Roi(mask)
+    area_all = int(np.sum(mask.mask))
+
+    groups = {}
+    for i, img in enumerate(images):
+        groups.setdefault(img.dtype, []).append(i)
+
+    result = [None] * len(images)
+    for dtype, channels in groups.items():
+        start = time.perf_counter()
+        stack = np.empty((len(channels), area_all), dtype=dtype)
+        for row, i in enumerate(channels):
+            stack[row] = mask.pixels(images[i])
+        timings["Gather"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        # Same precision as comparing the image with a python float threshold
+        th_dtype = dtype if np.issubdtype(dtype, np.inexact) else np.float64
+        th = np.asarray([thresholds[i] for i in channels], dtype=th_dtype)[:, None]
+        positive = stack >= th
+        area_positive = np.sum(positive, axis=1)
+        timings["Threshold"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        # Positive pixels of every channel, one contiguous segment per channel
+        positive_pixels = stack[positive]
+        ends = np.cumsum(area_positive)
+        starts = ends - area_positive
+        for row, i in enumerate(channels):
+            # Means are reduced per contiguous segment (views, no copies) so
+            # the summation order, and therefore the result, matches np.mean
+            result[i] = {
+                "Channel": names[i],
+                "Threshold": thresholds[i],
+                "Positive Area": int(area_positive[row]),
+                "Positive Mean": np.mean(positive_pixels[starts[row] : ends[row]]),
+                "Total Area": area_all,
+                "Total Mean": np.mean(stack[row]),
+                " Positive Fraction": float(area_positive[row]) / float(area_all),
+            }
+        timings["Reduce"] += time.perf_counter() - start
+    return result, timings
+
+
+def analyse_fibers(labels, images, names, thresholds, mask=None):
+    """Quantifies every channel inside every fiber
+
+    All fibers are reduced at once with weighted bincounts over the label
+    image, one pass per channel, instead of looping over the labels.
+
+    Parameters
+    ----------
+    labels
+        Fiber labels image, 0 is background
+    images
+        List of channel images
+    names
+        List of channel names
+    thresholds
+        List of channel thresholds (None if not thresholded)
+    mask, optional
+        Boolean mask or Roi. If provided, only the pixels inside it are
+        quantified. By default None
+
+    Returns
+    -------
+        Dictionary of columns: Fiber (label), Area and, for every channel,
+        Mean, Integrated and Positive Fraction. Positive Fraction is NaN for
+        channels without threshold. Only fibers with area are reported
+    """
+
+    if mask is not None and not isinstance(mask, Roi):
+        mask = Roi(mask)
+
+    def pixels(img):
+        return np.ravel(img) if mask is None else mask.pixels(img)
+
+    fiber_px = pixels(labels).astype(np.intp)
+    fibers, area = fiber_areas(labels, mask, fiber_px)
+    n_bins = fibers[-1] + 1 if fibers.size > 0 else 1
+
+    result = {"Fiber": fibers, "Area": area}
+    for img, name, th in zip(images, names, thresholds):
+        img_px = pixels(img)
+        integrated = np.bincount(fiber_px, weights=img_px, minlength=n_bins)[fibers]
+        result[f"{name} Mean"] = integrated / area
+        result[f"{name} Integrated"] = integrated
+        if th == None:
+            result[f"{name} Positive Fraction"] = np.full(fibers.size, np.nan)
+        else:
+            positive = np.bincount(fiber_px, weights=img_px >= th, minlength=n_bins)
+            result[f"{name} Positive Fraction"] = positive[fibers] / area
+    return result
+
+
+def fiber_areas(labels, mask=None, fiber_px=None):
+    """Labels and areas (pixels) of the fibers, inside the mask if provided
+
+    Returns
+    -------
+        Arrays with the labels of the fibers with area (0, the background,
+        excluded) and their areas
+    """
+
+    if fiber_px is None:
+        if mask is not None and not isinstance(mask, Roi):
+            mask = Roi(mask)
+        fiber_px = np.ravel(labels) if mask is None else mask.pixels(labels)
+        fiber_px = fiber_px.astype(np.intp)
+    area = np.bincount(fiber_px)
+    fibers = np.flatnonzero(area)
+    fibers = fibers[fibers != 0]
+    return fibers, area[fibers]
+
+
+def assign_points(labels, points, mask=None):
+    """Label of the pixel of every point, in a single vectorized lookup
+
+    Parameters
+    ----------
+    labels
+        Fiber labels image
+    points
+        DataFrame or structured array with the columns axis-0 and axis-1
+    mask, optional
+        Boolean mask or Roi. Points outside it are assigned to -1. By
+        default None
+
+    Returns
+    -------
+        Array with the label of every point, 0 for points outside any fiber
+        and -1 for points outside the image or the mask
+    """
+
+    rows = np.floor(np.asarray(points["axis-0"], dtype=np.float64)).astype(np.intp)
+    cols = np.floor(np.asarray(points["axis-1"], dtype=np.float64)).astype(np.intp)
+    inside = (
+        (rows >= 0) & (rows < labels.shape[0]) & (cols >= 0) & (cols < labels.shape[1])
+    )
+    if mask is not None:
+        if not isinstance(mask, Roi):
+            mask = Roi(mask)
+        inside &= mask.contains(rows, cols)
+
+    assigned = np.full(len(rows), -1, dtype=np.intp)
+    assigned[inside] = labels[rows[inside], cols[inside]]
+    return assigned
+
+
+def fiber_point_counts(fibers, area, assignments, names):
+    """Amount of points and point density of several channels in every fiber
+
+    Parameters
+    ----------
+    fibers, area
+        Labels and areas of the fibers, see fiber_areas
+    assignments
+        List with the fiber label of every point of every channel, see
+        assign_points
+    names
+        List of channel names
+
+    Returns
+    -------
+        Dictionary of columns: Fiber, Area and, for every channel, Points
+        and Point Density (points per pixel)
+    """
+
+    n_bins = fibers[-1] + 1 if fibers.size > 0 else 1
+    result = {"Fiber": fibers, "Area": area}
+    for assigned, name in zip(assignments, names):
+        # Fibers outside the mask can have larger labels
+        assigned = assigned[(assigned > 0) & (assigned < n_bins)]
+        counts = np.bincount(assigned, minlength=n_bins)[fibers]
+        result[f"{name} Points"] = counts
+        result[f"{name} Point Density"] = counts / area
+    return result
+
+
+def colocalization(images, thresholds, mask, chunk=CHUNK_SIZE):
+    """Pairwise colocalization of several channels in a single streaming pass
+
+    The in-mask pixels are read in blocks of rows of the bounding box, so
+    memory mapped images are streamed and only a (channels x chunk) block
+    is held in memory. Every block updates the sufficient statistics of all
+    pairs at once: channel sums, the cross products matrix XX' (of values
+    shifted by the mean of the first block, for numerical stability) and the
+    thresholded intensity products (X * P)P', P being the positive pixels.
+
+    Parameters
+    ----------
+    images
+        List of channel images
+    thresholds
+        List of channel thresholds
+    mask
+        Boolean mask or Roi
+    chunk, optional
+        Approximate amount of pixels per block, by default CHUNK_SIZE
+
+    Returns
+    -------
+        Dict of (channels x channels) arrays: 'Pearson', the Pearson
+        correlation coefficient, and 'Manders', where [i, j] is the fraction
+        of the positive intensity of channel i that lies on positive pixels
+        of channel j (M1 of the pair (i, j) is [i, j] and M2 is [j, i])
+    """
+
+    if not isinstance(mask, Roi):
+        mask = Roi(mask)
+    n_ch = len(images)
+    dtype = np.result_type(*[img.dtype for img in images])
+    # Same precision as comparing the image with a python float threshold
+    th_dtype = dtype if np.issubdtype(dtype, np.inexact) else np.float64
+    th = np.asarray(thresholds, dtype=th_dtype)[:, None]
+
+    n = 0
+    shift = None
+    sums = np.zeros(n_ch)
+    cross = np.zeros((n_ch, n_ch))
+    positive_cross = np.zeros((n_ch, n_ch))
+
+    rows, cols = mask.slices
+    step = max(1, chunk // max(1, cols.stop - cols.start))
+    for start in range(0, mask.mask.shape[0], step):
+        block = mask.mask[start : start + step]
+        region = slice(rows.start + start, rows.start + start + len(block)), cols
+        stack = np.empty((n_ch, np.count_nonzero(block)), dtype=dtype)
+        if stack.shape[1] == 0:
+            continue
+        for i, img in enumerate(images):
+            stack[i] = np.asarray(img[region])[block]
+
+        positive = stack >= th
+        values = stack.astype(np.float64)
+        if shift is None:
+            shift = np.mean(values, axis=1)
+        n += values.shape[1]
+        values -= shift[:, None]
+        sums += np.sum(values, axis=1)
+        cross += values @ values.T
+        values += shift[:, None]
+        values *= positive
+        positive_cross += values @ positive.T.astype(np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if n > 0:
+            means = sums / n
+            cov = cross / n - np.outer(means, means)
+            std = np.sqrt(np.diag(cov))
+            pearson = cov / np.outer(std, std)
+        else:
+            pearson = np.full((n_ch, n_ch), np.nan)
+        manders = positive_cross / np.diag(positive_cross)[:, None]
+
+    return {"Pearson": pearson, "Manders": manders}
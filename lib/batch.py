@@ -0,0 +1,141 @@
+"""Multi-sample execution
+
+This module runs a headless task (see lib.cli) on many samples in
+parallel. Every sample is processed in its own worker process, so a
+sample that crashes or exhausts its memory budget only fails that sample.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+run_batch
+    Runs a task on several samples and returns a summary
+"""
+import os
+import time
+import argparse
+import pandas as pd
+import multiprocessing as mp
+from tabulate import tabulate
+from datetime import datetime as dtm
+from multiprocessing.connection import wait
+
+from lib.models.Colors import Color
+
+
+def _worker(conn, task, name, params, memory):
+    """Runs a task on a sample inside a worker process"""
+
+    start = time.perf_counter()
+    try:
+        if memory != None:
+            import resource
+
+            budget = memory * 1024**2
+            resource.setrlimit(resource.RLIMIT_AS, (budget, budget))
+
+        import lib.cli as cli
+        import lib.utils as utils
+        from lib.models.State import State
+
+        args = argparse.Namespace(command=task, name=name, **params)
+        with utils.suppress_output(suppress_stdout=True, suppress_stderr=True):
+            cli.COMMANDS[task](State(), args)
+        conn.send(("ok", time.perf_counter() - start, ""))
+    except MemoryError:
+        conn.send(("failed", time.perf_counter() - start, "Memory budget exceeded"))
+    except BaseException as e:
+        conn.send(("failed", time.perf_counter() - start, f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_batch(task, samples, workers=None, memory=None, params={}, summary_path=None):
+    """Runs a task on several samples in parallel worker processes
+
+    Parameters
+    ----------
+    task
+        Name of a headless command: 'ingest', 'analyse', 'colocalization' or
+        'point-segm'
+    samples
+        List of sample names
+    workers, optional
+        Maximum amount of simultaneous worker processes, by default
+        os.cpu_count()
+    memory, optional
+        Address space budget of every worker in MB, by default unlimited
+    params, optional
+        Arguments of the command (see lib.cli), by default {}
+    summary_path, optional
+        Path of the csv summary, by default batch/{task}_{date}.csv
+
+    Returns
+    -------
+        List of dicts with the keys Sample, Task, Status, Time (s) and Error
+    """
+
+    clr = Color()
+    workers = os.cpu_count() if workers == None else max(1, workers)
+    ctx = mp.get_context("spawn")
+
+    pending = list(samples)
+    running = {}  # sentinel: (name, process, connection)
+    summary = []
+
+    print(
+        f"{clr.CYAN}Running {task} on {len(pending)} samples with {workers} workers...{clr.ENDC}"
+    )
+
+    while pending or running:
+        while pending and len(running) < workers:
+            name = pending.pop(0)
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(
+                target=_worker,
+                args=(send_conn, task, name, params, memory),
+                name=f"hipo-{task}-{name}",
+            )
+            process.start()
+            send_conn.close()
+            running[process.sentinel] = (name, process, recv_conn)
+
+        for sentinel in wait(list(running.keys())):
+            name, process, conn = running.pop(sentinel)
+            process.join()
+            if conn.poll():
+                status, seconds, error = conn.recv()
+            else:
+                # The worker died without reporting, e.g. killed by the OOM killer
+                status, seconds, error = (
+                    "crashed",
+                    None,
+                    f"Worker exited with code {process.exitcode}",
+                )
+            conn.close()
+
+            color = clr.GREEN if status == "ok" else clr.RED
+            print(f"{color}[{status}] {name}{clr.ENDC} {error}")
+            summary.append(
+                {
+                    "Sample": name,
+                    "Task": task,
+                    "Status": status,
+                    "Time (s)": None if seconds == None else round(seconds, 2),
+                    "Error": error,
+                }
+            )
+
+    order = {name: i for i, name in enumerate(samples)}
+    summary.sort(key=lambda r: order[r["Sample"]])
+    df = pd.DataFrame(
+        summary, columns=["Sample", "Task", "Status", "Time (s)", "Error"]
+    )
+    if summary_path == None:
+        os.makedirs("batch", exist_ok=True)
+        summary_path = f'batch/{task}_{dtm.now().strftime("%Y-%m-%d-%H-%M-%S")}.csv'
+    df.to_csv(summary_path, index=False)
+
+    print(tabulate(df, headers="keys", tablefmt="github", showindex=False))
+    print(f"{clr.GREY}Summary at {summary_path}{clr.ENDC}")
+    return summary
@@ -0,0 +1,147 @@
+"""Content-hash cache of ingested samples
+
+This module contains the functions used to identify the input files of a
+sample by the hash of their content, and to reuse the artifacts (channel
+store, mask, statistics) already built by another sample from the same
+inputs. Reused files are hard-linked when possible, which is safe because
+every artifact is replaced atomically (written to a temporary file and
+renamed) instead of being modified in place.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+file_hash
+    Hash of the content of a file
+source_key
+    Size and modification time of a file
+find_sample
+    Sample whose manifest matches a condition
+link_files
+    Hard-links (or copies) files from a directory into another
+atomic_write
+    Opens a temporary file that replaces a file when it is closed
+"""
+import os
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+from lib.models.Manifest import Manifest
+
+
+def file_hash(path, extra=None):
+    """sha256 of the content of a file, read in blocks
+
+    Parameters
+    ----------
+    path
+        Path of the file
+    extra, optional
+        String added to the hash, e.g. parameters of the artifact built from
+        the file. By default None
+    """
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    if extra != None:
+        h.update(extra.encode())
+    return h.hexdigest()
+
+
+def source_key(path):
+    """Size and modification time of a file, None if it doesn't exist
+
+    Cheaper than file_hash, used to detect artifacts (e.g. a point index)
+    built from a file that has been written again since.
+    """
+
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def find_sample(condition, files=(), exclude=None):
+    """Finds a sample whose manifest fulfills a condition
+
+    Parameters
+    ----------
+    condition
+        Function of a Manifest, returning True if the sample matches
+    files, optional
+        Files (relative to the sample directory) the sample must have
+    exclude, optional
+        Name of a sample to ignore, by default None
+
+    Returns
+    -------
+        Name of the sample, None if no sample matches
+    """
+
+    if not os.path.isdir("samples"):
+        return None
+    for name in sorted(os.listdir("samples")):
+        if name == exclude or not Manifest.exists(name):
+            continue
+        if not all(os.path.exists(f"samples/{name}/{f}") for f in files):
+            continue
+        try:
+            manifest = Manifest.load(name)
+        except (OSError, ValueError, KeyError):
+            continue
+        if condition(manifest):
+            return name
+    return None
+
+
+def link_files(src, dst, names=None):
+    """Hard-links files of a directory into another, copying them if the
+    file system doesn't support hard links. Existing files are replaced
+
+    Parameters
+    ----------
+    src, dst
+        Source and destination directories
+    names, optional
+        File names, by default every file in src
+    """
+
+    os.makedirs(dst, exist_ok=True)
+    if names == None:
+        names = [f for f in os.listdir(src) if os.path.isfile(f"{src}/{f}")]
+    for f in names:
+        if os.path.lexists(f"{dst}/{f}"):
+            os.remove(f"{dst}/{f}")
+        try:
+            os.link(f"{src}/{f}", f"{dst}/{f}")
+        except OSError:
+            shutil.copy2(f"{src}/{f}", f"{dst}/{f}")
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """Opens a temporary file that replaces path when it is closed
+
+    The file is written next to path and renamed over it, so a hard-linked
+    file is never modified: path gets a new inode and the other samples
+    keep the old one. Nothing is replaced if writing fails.
+
+    Parameters
+    ----------
+    path
+        Path of the file
+    mode, optional
+        Mode of the temporary file, 'w' or 'wb'. By default 'w'
+    """
+
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,456 @@
+"""Headless command line interface
+
+This module contains the non-interactive subcommands of HIPO, used to
+drive ingest, thresholding, analysis, colocalization and point
+segmentation from scripts or cluster schedulers. They reuse the State and
+Sample objects, but never open a file dialog or a napari viewer, and
+return an exit status instead of waiting for user input.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+add_subcommands
+    Adds the subcommands to the argument parser of main.py
+run
+    Runs the subcommand selected in the parsed arguments
+"""
+import os
+import sys
+import pandas as pd
+
+import lib.batch as batch
+import lib.importtime as importtime
+import lib.consistency as consistency
+from lib.models.State import State
+from lib.models.Sample import Sample
+from lib.models.Colors import Color
+from lib.models.Manifest import Manifest
+from lib.image import POINT_PARAMS
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+
+
+class CommandError(Exception):
+    pass
+
+
+def add_subcommands(parser):
+    """Adds the headless subcommands to an argparse parser"""
+
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+    p = subparsers.add_parser("list", help="List samples")
+
+    p = subparsers.add_parser(
+        "ingest",
+        help="Create a sample from its input files. Files not given are taken "
+        "from samples/NAME/input/",
+    )
+    p.add_argument("name", help="Name of the new sample")
+    p.add_argument("--txt", help="Summary (.txt) file")
+    p.add_argument("--geojson", help="ROI (.geojson) file")
+    p.add_argument("--tiff", help="Image (.tiff) file")
+
+    p = subparsers.add_parser(
+        "roi",
+        help="Rebuild the mask of a sample from a geojson file. The mask is "
+        "only rasterized again if the file changed",
+    )
+    p.add_argument("name", help="Name of the sample")
+    p.add_argument("--geojson", required=True, help="ROI (.geojson) file")
+
+    p = subparsers.add_parser("threshold", help="Set channel thresholds")
+    p.add_argument("name", help="Name of the sample")
+    p.add_argument(
+        "--file",
+        help="csv file with the columns Channel and Threshold. Channels can be "
+        "given by name, label or index",
+    )
+    p.add_argument(
+        "--set",
+        nargs="+",
+        default=[],
+        metavar="CHANNEL=TH",
+        help="Thresholds given as channel=value pairs",
+    )
+
+    p = subparsers.add_parser("analyse", help="Analyse the thresholded channels")
+    p.add_argument("name", help="Name of the sample")
+    p.add_argument(
+        "--fibers", action="store_true", help="Also run the per-fiber analysis"
+    )
+    p.add_argument(
+        "--fiber-points",
+        action="store_true",
+        help="Also count the points of every channel inside every fiber",
+    )
+
+    p = subparsers.add_parser(
+        "colocalization",
+        help="Pearson and Manders colocalization of pairs of thresholded channels",
+    )
+    p.add_argument("name", help="Name of the sample")
+    p.add_argument(
+        "--channel",
+        nargs="+",
+        default=None,
+        help="Channels (name, label or index), by default all thresholded channels",
+    )
+
+    p = subparsers.add_parser("point-segm", help="Segment dot-like elements")
+    p.add_argument("name", help="Name of the sample")
+    add_point_segm_arguments(p)
+
+    p = subparsers.add_parser(
+        "batch", help="Run a task on many samples in parallel worker processes"
+    )
+    p.add_argument(
+        "task", choices=["ingest", "analyse", "colocalization", "point-segm"]
+    )
+    p.add_argument(
+        "--samples",
+        nargs="+",
+        default=None,
+        help="Samples to process. By default, all samples not ingested yet for "
+        "ingest (their input files must be in samples/NAME/input/) and all "
+        "ingested samples otherwise",
+    )
+    p.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Worker processes"
+    )
+    p.add_argument(
+        "--memory", type=int, default=None, help="Memory budget per worker (MB)"
+    )
+    p.add_argument(
+        "--fibers", action="store_true", help="Also run the per-fiber analysis"
+    )
+    p.add_argument(
+        "--fiber-points",
+        action="store_true",
+        help="Also count the points of every channel inside every fiber",
+    )
+    add_point_segm_arguments(p, required=False)
+    # Batch ingest always reads the input files from samples/NAME/input/
+    p.set_defaults(txt=None, geojson=None, tiff=None)
+
+    p = subparsers.add_parser(
+        "check-imports",
+        help="Check that HIPO starts without importing GUI and image libraries, "
+        "within an import time budget",
+    )
+    p.add_argument(
+        "--budget",
+        type=float,
+        default=importtime.BUDGET_MS,
+        help="Maximum import time (ms)",
+    )
+
+    return subparsers
+
+
+def add_point_segm_arguments(p, required=True):
+    p.add_argument(
+        "--channel",
+        nargs="+",
+        required=required,
+        help="Channel names, labels or indexes",
+    )
+    p.add_argument(
+        "--params-from",
+        default=None,
+        metavar="SAMPLE",
+        help="Reuse the point segmentation parameters of the same channels in "
+        "another sample",
+    )
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Channels (or tiles, with --tile) segmented concurrently",
+    )
+    p.add_argument(
+        "--tile",
+        type=int,
+        default=None,
+        help="Process the images in tiles of this size (pixels) to bound memory",
+    )
+    # Parameters not given are taken from the last segmentation of the channel,
+    # or from lib.image.POINT_PARAMS
+    p.add_argument("--percentile", type=float, help="Normalization percentile")
+    p.add_argument("--sigma", type=float, help="Gaussian sigma")
+    p.add_argument("--mode", choices=["None", "Otsu"])
+    p.add_argument(
+        "--backend",
+        choices=["contour", "components"],
+        help="Measure contours one by one, or all connected components at once",
+    )
+    p.add_argument("--min-size", type=float, help="Min. point area")
+    p.add_argument("--max-size", type=float, help="Max. point area")
+    p.add_argument("--min-ratio", type=float, help="Min. aspect ratio")
+    p.add_argument("--max-ratio", type=float, help="Max. aspect ratio")
+    p.add_argument(
+        "--min-area-percentile",
+        type=float,
+        help="Discard points with an area below this percentile",
+    )
+    p.add_argument(
+        "--max-area-percentile",
+        type=float,
+        help="Discard points with an area above this percentile",
+    )
+
+
+####################################################################
+############################## UTILS ###############################
+####################################################################
+
+
+def load_sample(state, name):
+    if name not in state.samples["Sample"].to_list():
+        raise CommandError(f"Sample {name} does not exist")
+    state.load_sample(name)
+    if state.current_sample.channels == None:
+        raise CommandError(f"Sample {name} has no channels")
+    return state.current_sample
+
+
+def find_channel(sample, key):
+    """Returns the index of a channel given its name, label or index"""
+
+    key = str(key)
+    for i, c in enumerate(sample.channels):
+        if key == c.name or key == c.label:
+            return i
+    if key.isdigit() and int(key) < len(sample.channels):
+        return int(key)
+    raise CommandError(f"Channel {key} not found in sample {sample.name}")
+
+
+####################################################################
+########################### SUBCOMMANDS ############################
+####################################################################
+
+
+def cmd_list(state, args):
+    print(state.list_samples())
+
+
+def input_files(name):
+    """Returns the txt, geojson and tiff files in samples/{name}/input/"""
+
+    error = consistency.check_input_files(name)
+    if error != None:
+        raise CommandError(str(error))
+    files = {}
+    for f in os.listdir(f"samples/{name}/input"):
+        files[f.rsplit(".", 1)[-1]] = f"samples/{name}/input/{f}"
+    return files
+
+
+def cmd_ingest(state, args):
+    if Manifest.ingested(args.name):
+        raise CommandError(f"A sample named {args.name} already exists")
+
+    files = {"txt": args.txt, "geojson": args.geojson, "tiff": args.tiff}
+    if None in files.values():
+        found = input_files(args.name)
+        files = {k: found[k] if v == None else v for k, v in files.items()}
+    for f in files.values():
+        if not os.path.isfile(f):
+            raise CommandError(f"Input file {f} does not exist")
+
+    Sample(name=args.name).make_dir_structure(exist_ok=True)
+    state.set_samples()
+    state.load_sample(args.name, files["txt"], files["geojson"], files["tiff"])
+    state.dump()
+
+
+def cmd_roi(state, args):
+    sample = load_sample(state, args.name)
+    if not os.path.isfile(args.geojson):
+        raise CommandError(f"File {args.geojson} does not exist")
+    with sample.transaction():
+        rebuilt = sample.make_mask(args.geojson)
+    # In-mask statistics depend on the mask
+    if rebuilt:
+        sample.compute_stats()
+    state.dump()
+
+
+def cmd_threshold(state, args):
+    sample = load_sample(state, args.name)
+
+    thresholds = []
+    if args.file != None:
+        df = pd.read_csv(args.file)
+        thresholds += list(zip(df["Channel"], df["Threshold"]))
+    for pair in args.set:
+        key, _, value = pair.rpartition("=")
+        if key == "":
+            raise CommandError(f"Invalid threshold {pair}, expected channel=value")
+        thresholds.append((key, value))
+    if len(thresholds) == 0:
+        raise CommandError("No thresholds given, use --file or --set")
+
+    with sample.transaction():
+        for key, value in thresholds:
+            sample.channels[find_channel(sample, key)].th = float(value)
+        sample.update_df()
+
+
+def cmd_analyse(state, args):
+    sample = load_sample(state, args.name)
+
+    thresholded = [i for i, c in enumerate(sample.channels) if c.th != None]
+    if len(thresholded) == 0:
+        raise CommandError(f"Sample {args.name} has no thresholded channels")
+    if not sample.has_images(im_type="image"):
+        raise CommandError(f"Sample {args.name} has no channel images")
+    sample.analyse(thresholded)
+
+    if args.fibers:
+        if sample.load_fiber_labels() == None:
+            raise CommandError(f"Sample {args.name} has no fiber labels")
+        sample.load_channels_images(im_type="image")
+        sample.analyse_fibers()
+
+    if args.fiber_points:
+        if sample.count_fiber_points() == None:
+            raise CommandError(f"Sample {args.name} has no fiber labels")
+    state.dump()
+
+
+def cmd_colocalization(state, args):
+    sample = load_sample(state, args.name)
+
+    if args.channel == None:
+        options = [i for i, c in enumerate(sample.channels) if c.th != None]
+    else:
+        options = [find_channel(sample, key) for key in args.channel]
+    missing = [
+        sample.channels[i].name for i in options if sample.channels[i].th == None
+    ]
+    if len(missing) > 0:
+        raise CommandError(f"Channels {missing} have no threshold")
+    if len(options) < 2:
+        raise CommandError("Colocalization requires at least two thresholded channels")
+    if sample.load_channels_images(im_type="image", options=options) == None:
+        raise CommandError(f"Sample {args.name} has no channel images")
+    sample.colocalization(options)
+    state.dump()
+
+
+def cmd_point_segm(state, args):
+    sample = load_sample(state, args.name)
+    options = [find_channel(sample, key) for key in args.channel]
+    if not sample.has_images(im_type="image"):
+        raise CommandError(f"Sample {args.name} has no channel images")
+
+    reference = None
+    if args.params_from != None:
+        reference = Manifest.load(args.params_from)
+        if reference == None:
+            raise CommandError(f"Sample {args.params_from} does not exist")
+
+    params = {k: getattr(args, k) for k in POINT_PARAMS if getattr(args, k) != None}
+    with sample.transaction():
+        for opt in options:
+            if reference != None:
+                c = sample.channels[opt]
+                entry = reference.find_channel(c.name)
+                entry = reference.find_channel(c.label) if entry == None else entry
+                if entry == None or entry.get("point_params") == None:
+                    raise CommandError(
+                        f"Channel {c.name} has no point segmentation in sample "
+                        f"{args.params_from}"
+                    )
+                c.point_params = entry["point_params"]
+        sample.segment_points(
+            options, params=params, workers=args.threads, tile=args.tile
+        )
+        sample.update_df()
+        for opt in options:
+            sample.save_points(opt)
+    state.dump()
+
+
+def cmd_batch(state, args):
+    if args.task == "point-segm" and args.channel == None:
+        raise CommandError("point-segm requires --channel")
+
+    samples = args.samples
+    if samples == None:
+        samples = [
+            s
+            for s in state.samples["Sample"]
+            if Manifest.ingested(s) != (args.task == "ingest")
+        ]
+    params = {
+        k: v
+        for k, v in vars(args).items()
+        if k not in ["command", "task", "samples", "workers", "memory"]
+    }
+
+    summary = batch.run_batch(
+        args.task, samples, workers=args.workers, memory=args.memory, params=params
+    )
+    failed = [r["Sample"] for r in summary if r["Status"] != "ok"]
+    if len(failed) > 0:
+        raise CommandError(f"{len(failed)} of {len(summary)} samples failed: {failed}")
+
+
+def cmd_check_imports(state, args):
+    clr = Color()
+    result = importtime.check_imports(budget=args.budget)
+    print(
+        pd.DataFrame(result["top"], columns=["Module", "Cumulative (ms)"]).to_string(
+            index=False, float_format="{:.1f}".format
+        )
+    )
+    print(f"Total import time: {result['total']:.0f} ms (budget {args.budget:.0f} ms)")
+    if len(result["errors"]) > 0:
+        raise CommandError(". ".join(result["errors"]))
+    print(f"{clr.GREEN}No heavy modules imported at startup{clr.ENDC}")
+
+
+COMMANDS = {
+    "list": cmd_list,
+    "ingest": cmd_ingest,
+    "roi": cmd_roi,
+    "threshold": cmd_threshold,
+    "analyse": cmd_analyse,
+    "colocalization": cmd_colocalization,
+    "point-segm": cmd_point_segm,
+    "batch": cmd_batch,
+    "check-imports": cmd_check_imports,
+}
+
+
+def run(args):
+    """Runs a headless subcommand
+
+    Returns
+    -------
+        Exit status, EXIT_OK on success and EXIT_ERROR on failure
+    """
+
+    clr = Color()
+    if not os.path.exists("samples"):
+        os.mkdir("samples")
+
+    try:
+        state = State(debug=args.debug)
+        COMMANDS[args.command](state, args)
+    except CommandError as e:
+        print(f"{clr.RED}Error: {e}{clr.ENDC}", file=sys.stderr)
+        return EXIT_ERROR
+    except Exception as e:
+        print(f"{clr.RED}{type(e).__name__}: {e}{clr.ENDC}", file=sys.stderr)
+        if args.debug:
+            raise
+        return EXIT_ERROR
+
+    print(f"{clr.GREEN}Done: {args.command} {getattr(args, 'name', '')}{clr.ENDC}")
+    return EXIT_OK
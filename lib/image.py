@@ -2,22 +2,134 @@
 Author: José Verdú-Díaz
 """
 
-import cv2
 import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
+import lib.tiling as tiling
 from lib.utils import Color
+from lib.models.Roi import Roi
 
+# Parameters of the point segmentation (see point_segmentation)
+POINT_PARAMS = {
+    "percentile": 99.9,
+    "sigma": 1.0,
+    "mode": "Otsu",
+    "min_size": None,
+    "max_size": None,
+    "min_ratio": None,
+    "max_ratio": None,
+    "min_area_percentile": 0,
+    "max_area_percentile": 100,
+    "backend": "contour",
+}
+# Bins of the histograms used to find percentiles in tiles
+HIST_BINS = 4096
+# Points found by segment_points: position (row, column) and area
+POINT_DTYPE = np.dtype(
+    [("axis-0", np.int64), ("axis-1", np.int64), ("area", np.float64)]
+)
 
-def segment_points(img, size=(None, None), ratio=(None, None)):
-    clr = Color()
+
+def blur_threshold(data, p, s, mode="None", index=None):
+    """Preprocesses an image for the segmentation of dot-like elements
+
+    The image is normalized to its p percentile and clipped to 1, cast to
+    uint8, blurred with a gaussian filter and, optionally, thresholded with
+    Otsu's method.
+
+    Parameters
+    ----------
+    data
+        Image
+    p
+        Percentile used for normalization
+    s
+        Sigma of the gaussian filter
+    mode, optional
+        'None' or 'Otsu', by default 'None'
+    index, optional
+        PercentileIndex of the image, used to look up the percentile without
+        sorting the image. By default None
+
+    Returns
+    -------
+        Blurred image, or boolean image if mode is 'Otsu'
+    """
+
+    # Image libraries are imported on use, see lib.importtime
+    from skimage.filters._gaussian import gaussian
+    from skimage.filters.thresholding import threshold_otsu
+
+    u = np.percentile(data, p) if index is None else index.percentile(p)
+    _data = data / u
+    _data = np.where(_data < 1, _data, 1)
+    _data = np.array(_data * 255, dtype="uint8")
+    _data = gaussian(_data, sigma=s)
+    if mode == "Otsu":
+        return _data > threshold_otsu(_data)
+    return _data
+
+
+def segment_points(
+    img, size=(None, None), ratio=(None, None), verbose=True, backend="contour"
+):
+    """Finds the dot-like elements of a preprocessed image
+
+    Parameters
+    ----------
+    img
+        Preprocessed image (see blur_threshold), non-zero pixels are foreground
+    size, optional
+        (min, max) area of the points, as measured by the backend, by default
+        (None, None). The area of a contour polygon is smaller than the pixel
+        count of the same object, so the same bounds can keep different
+        objects with each backend
+    ratio, optional
+        (min, max) aspect ratio (width / height) of the bounding box of the
+        points, by default (None, None)
+    verbose, optional
+        Print progress, by default True
+    backend, optional
+        'contour' finds the external contours and measures them one by one
+        (area of the contour polygon, centroid of the contour). 'components'
+        labels the 8-connected components once and measures all of them at
+        once (area in pixels, centroid of the pixels). By default 'contour'
+
+    Returns
+    -------
+        Structured array of points (see POINT_DTYPE)
+    """
 
     img = np.array(img * 255, dtype="uint8")
+    if backend == "components":
+        points, found = _segment_components(img, size, ratio)
+    elif backend == "contour":
+        points, found = _segment_contours(img, size, ratio, verbose)
+    else:
+        raise ValueError(f"Unknown point segmentation backend {backend}")
+
+    if verbose:
+        clr = Color()
+        print(f"{clr.GREY}Contours Found: {found}{clr.ENDC}")
+        print(f"{clr.GREY}Centroids Found: {len(points)}{clr.ENDC}")
+    return points
+
+
+def _segment_contours(img, size, ratio, verbose):
+    import cv2
+
+    clr = Color()
 
     contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
     filtered = []
-    for cnt in tqdm(contours, desc=f"{clr.GREY}Finding Contours: ", postfix=clr.ENDC):
+    for cnt in tqdm(
+        contours,
+        desc=f"{clr.GREY}Finding Contours: ",
+        postfix=clr.ENDC,
+        disable=not verbose,
+    ):
         area = cv2.contourArea(cnt)
         if area == 0:
             continue
@@ -35,14 +147,551 @@ def segment_points(img, size=(None, None), ratio=(None, None)):
         else:
             filtered.append({"contour": cnt, "area": area})
 
-    points = []
-    for point in tqdm(filtered, desc=f"{clr.GREY}Creating Points: ", postfix=clr.ENDC):
+    points = np.empty(len(filtered), dtype=POINT_DTYPE)
+    for i, point in enumerate(
+        tqdm(
+            filtered,
+            desc=f"{clr.GREY}Creating Points: ",
+            postfix=clr.ENDC,
+            disable=not verbose,
+        )
+    ):
         M = cv2.moments(point["contour"])
         cX = int(M["m10"] / M["m00"])
         cY = int(M["m01"] / M["m00"])
-        a = point["area"]
-        points.append([cY, cX, a])
+        points[i] = (cY, cX, point["area"])
+    return points, len(contours)
+
+
+def _segment_components(img, size, ratio):
+    import cv2
+
+    n, _, stats, centroids = cv2.connectedComponentsWithStats(
+        img, connectivity=8, ltype=cv2.CV_32S
+    )
+    # Label 0 is the background
+    points = _component_points(
+        stats[1:, cv2.CC_STAT_AREA].astype(np.float64),
+        stats[1:, cv2.CC_STAT_WIDTH],
+        stats[1:, cv2.CC_STAT_HEIGHT],
+        centroids[1:],
+        size,
+        ratio,
+    )
+    return points, n - 1
+
+
+def _component_points(area, width, height, centroids, size, ratio):
+    """Filters components by size and ratio and returns them as points
+
+    Points are sorted by position, so the order doesn't depend on how the
+    components were labelled (e.g. in tiles).
+    """
+
+    aspect_ratio = width / height
+    keep = np.ones(len(area), dtype=bool)
+    if not size[0] == None:
+        keep &= area >= size[0]
+    if not size[1] == None:
+        keep &= area <= size[1]
+    if not ratio[0] == None:
+        keep &= aspect_ratio >= ratio[0]
+    if not ratio[1] == None:
+        keep &= aspect_ratio <= ratio[1]
+
+    points = np.empty(np.count_nonzero(keep), dtype=POINT_DTYPE)
+    # Truncated like the centroids of the contour backend
+    points["axis-0"] = centroids[keep, 1].astype(np.int64)
+    points["axis-1"] = centroids[keep, 0].astype(np.int64)
+    points["area"] = area[keep]
+    return np.sort(points, order=["axis-0", "axis-1", "area"])
+
+
+def filter_points(points, min=0, max=100):
+    """Keeps the points whose area is between two percentiles of the areas
+
+    Parameters
+    ----------
+    points
+        Structured array of points (see POINT_DTYPE)
+    min, optional
+        Percentile of the minimum area, by default 0
+    max, optional
+        Percentile of the maximum area, by default 100
+    """
+
+    if len(points) == 0:
+        return points
+    a_min = np.percentile(points["area"], min)
+    a_max = np.percentile(points["area"], max)
+    return points[(points["area"] >= a_min) & (points["area"] <= a_max)]
+
+
+####################################################################
+######################## POINT SEGMENTATION ########################
+####################################################################
+
+
+def _percentile_position(size, p):
+    """Ranks and weight interpolated by np.percentile (linear method)"""
+
+    virtual = np.float64(p) / 100 * (size - 1)
+    lo = int(np.floor(virtual))
+    hi = min(lo + 1, size - 1)
+    return lo, hi, float(virtual - lo)
+
+
+def _lerp(a, b, gamma):
+    """Linear interpolation with the same rounding as np.percentile"""
+
+    diff = b - a
+    if gamma >= 0.5:
+        return b - diff * (1 - gamma)
+    return a + diff * gamma
+
+
+def masked_percentile(pixels, size, p):
+    """Returns np.percentile of an image whose pixels outside a mask are 0
+
+    Parameters
+    ----------
+    pixels
+        In-mask pixels of the image
+    size
+        Amount of pixels of the whole image
+    p
+        Percentile, between 0 and 100
+    """
+
+    pixels = np.ravel(pixels)
+    zeros = size - pixels.size
+    negative = int(np.count_nonzero(pixels < 0))
+    lo, hi, gamma = _percentile_position(size, p)
+
+    # Rank k of the whole image is a negative pixel, a zero outside the mask
+    # or the pixel of rank k - zeros
+    ranks = {k: k if k < negative else k - zeros for k in (lo, hi)}
+    kth = [r for k, r in ranks.items() if k < negative or k >= negative + zeros]
+    part = np.partition(pixels, kth) if len(kth) > 0 else pixels
+    values = [
+        part[ranks[k]]
+        if k < negative or k >= negative + zeros
+        else pixels.dtype.type(0)
+        for k in (lo, hi)
+    ]
+    return _lerp(*values, gamma)
+
+
+def tiled_masked_percentile(img, roi, size, p, tile=tiling.TILE_SIZE, workers=None):
+    """Same as masked_percentile(roi.pixels(img), size, p), processing tiles
+
+    The ranks of the percentile are found in a histogram of the in-mask
+    pixels, and the exact values among the pixels of their histogram bins,
+    so the in-mask pixels are never gathered at once.
+    """
+
+    tiles = tiling.tile_slices(roi.slices, tile)
+
+    def pixels(core):
+        return np.asarray(img[core])[roi.mask[tiling.local(core, roi.slices)]]
+
+    def extent(core):
+        v = pixels(core)
+        if v.size == 0:
+            return None
+        return v.min(), v.max(), int(np.count_nonzero(v < 0)), v.size
+
+    extents = [e for row in tiling.map_tiles(extent, tiles, workers) for e in row]
+    extents = [e for e in extents if e != None]
+    count = sum(e[3] for e in extents)
+    zeros = size - count
+    negative = sum(e[2] for e in extents)
+    lo, hi, gamma = _percentile_position(size, p)
+
+    ranks = {k: k if k < negative else k - zeros for k in (lo, hi)}
+    needed = {r for k, r in ranks.items() if k < negative or k >= negative + zeros}
+    values = {}
+    if len(needed) > 0:
+        v_min = min(e[0] for e in extents)
+        v_max = max(e[1] for e in extents)
+        bins = HIST_BINS if v_max > v_min else 1
+        scale = bins / (np.float64(v_max) - np.float64(v_min)) if bins > 1 else 0
+
+        def bin_index(v):
+            idx = ((v.astype(np.float64) - np.float64(v_min)) * scale).astype(np.int64)
+            return np.clip(idx, 0, bins - 1)
+
+        def histogram(core):
+            return np.bincount(bin_index(pixels(core)), minlength=bins)
+
+        counts = sum(
+            c for row in tiling.map_tiles(histogram, tiles, workers) for c in row
+        )
+        cdf = np.cumsum(counts)
+        # Bin of every rank, and rank inside the bin
+        in_bin = {}
+        for r in needed:
+            b = int(np.searchsorted(cdf, r, side="right"))
+            in_bin[r] = (b, r - (cdf[b - 1] if b > 0 else 0))
+        targets = np.array(sorted({b for b, _ in in_bin.values()}))
+
+        def bin_values(core):
+            v = pixels(core)
+            idx = bin_index(v)
+            return {b: np.unique(v[idx == b], return_counts=True) for b in targets}
+
+        found = [d for row in tiling.map_tiles(bin_values, tiles, workers) for d in row]
+        for r, (b, k) in in_bin.items():
+            v = np.concatenate([d[b][0] for d in found])
+            c = np.concatenate([d[b][1] for d in found])
+            v, inverse = np.unique(v, return_inverse=True)
+            c = np.bincount(inverse, weights=c)
+            values[r] = v[np.searchsorted(np.cumsum(c), k, side="right")]
+
+    dtype = img.dtype.type
+    return _lerp(
+        *[
+            values[ranks[k]] if k < negative or k >= negative + zeros else dtype(0)
+            for k in (lo, hi)
+        ],
+        gamma,
+    )
 
-    print(f"{clr.GREY}Contours Found: {len(contours)}{clr.ENDC}")
-    print(f"{clr.GREY}Centroids Found: {len(points)}{clr.ENDC}")
+
+def point_segmentation(
+    img, params=None, mask=None, verbose=False, tile=None, workers=None
+):
+    """Segments the dot-like elements of a channel
+
+    Headless equivalent of the point segmentation in Sample.napari_display:
+    the image is masked and preprocessed with blur_threshold, and the points
+    are found with segment_points and filtered by area percentiles. With a
+    Roi, only the bounding box (plus the reach of the gaussian filter) is
+    processed, with the same result as processing the whole masked image.
+
+    Parameters
+    ----------
+    img
+        Channel image
+    params, optional
+        Dict of parameters, missing keys take the values of POINT_PARAMS
+    mask, optional
+        Boolean mask or Roi, by default None
+    verbose, optional
+        Print progress, by default False
+    tile, optional
+        Size of the tiles. If provided, the image is processed in tiles of
+        at most tile x tile pixels (see segment_points_tiled), with the same
+        result. By default None
+    workers, optional
+        Amount of tiles processed at the same time, by default the
+        ThreadPoolExecutor default
+
+    Returns
+    -------
+        Structured array of points (see POINT_DTYPE) in full frame coordinates
+    """
+
+    params = {**POINT_PARAMS, **({} if params == None else params)}
+    kwargs = {
+        "size": (params["min_size"], params["max_size"]),
+        "ratio": (params["min_ratio"], params["max_ratio"]),
+        "verbose": verbose,
+        "backend": params["backend"],
+    }
+
+    if tile != None:
+        roi = Roi(np.ones(img.shape, dtype=bool)) if mask is None else mask
+        roi = roi if isinstance(roi, Roi) else Roi(roi)
+        points = segment_points_tiled(img, roi, params, tile, workers, verbose)
+    elif mask is None:
+        res = blur_threshold(img, params["percentile"], params["sigma"], params["mode"])
+        points = segment_points(res, **kwargs)
+    else:
+        if not isinstance(mask, Roi):
+            mask = Roi(mask)
+        res, offset = _blur_threshold_roi(img, mask, params)
+        points = segment_points(res, **kwargs)
+        points["axis-0"] += offset[0]
+        points["axis-1"] += offset[1]
+
+    return filter_points(
+        points, params["min_area_percentile"], params["max_area_percentile"]
+    )
+
+
+def _masked_window(img, roi, window):
+    """np.where(mask, img, 0) inside a window of the full frame"""
+
+    out = np.zeros([sl.stop - sl.start for sl in window], dtype=img.dtype)
+    inter = tuple(
+        slice(max(w.start, b.start), min(w.stop, b.stop))
+        for w, b in zip(window, roi.slices)
+    )
+    if any(sl.stop <= sl.start for sl in inter):
+        return out
+    out[tiling.local(inter, window)] = np.where(
+        roi.mask[tiling.local(inter, roi.slices)], img[inter], 0
+    )
+    return out
+
+
+def _blur(img, roi, core, u, s):
+    """Normalized, clipped, uint8 and blurred masked image inside a region
+
+    The masked image is read with a halo of the gaussian radius around the
+    region, so the result is the same as blurring the whole frame.
+    """
+
+    from skimage.filters._gaussian import gaussian
+
+    radius = int(4.0 * s + 0.5)  # truncate of the skimage gaussian filter
+    window = tiling.grow(core, radius, roi.shape)
+    _data = _masked_window(img, roi, window) / u
+    _data = np.where(_data < 1, _data, 1)
+    _data = np.array(_data * 255, dtype="uint8")
+    return gaussian(_data, sigma=s)[tiling.local(core, window)]
+
+
+def _otsu(counts, edges, zeros, lo):
+    """Otsu threshold of a histogram, plus zeros pixels of value 0"""
+
+    from skimage.filters.thresholding import threshold_otsu
+
+    counts = (
+        counts
+        + np.histogram(np.zeros(1), bins=len(counts), range=(lo, edges[-1]))[0] * zeros
+    )
+    centers = (edges[:-1] + edges[1:]) / 2.0
+    return threshold_otsu(hist=(counts, centers))
+
+
+def _blur_threshold_roi(img, roi, params):
+    """blur_threshold of the masked image, computed around the Roi only
+
+    Returns
+    -------
+        Result inside the bounding box grown by the gaussian radius, and the
+        position of that region in the full frame. The full frame result is
+        0 (or False) outside the region.
+    """
+
+    p, s, mode = params["percentile"], params["sigma"], params["mode"]
+    n = int(np.prod(roi.shape))
+    inner = tiling.grow(roi.slices, int(4.0 * s + 0.5), roi.shape)
+
+    u = masked_percentile(roi.pixels(img), n, p)
+    _data = _blur(img, roi, inner, u, s)
+    offset = (inner[0].start, inner[1].start)
+    if mode != "Otsu":
+        return _data, offset
+
+    # Otsu on the histogram of the whole frame, where the pixels outside the
+    # inner region are 0
+    zeros = n - _data.size
+    lo = min(_data.min(), 0) if zeros > 0 else _data.min()
+    hi = max(_data.max(), 0) if zeros > 0 else _data.max()
+    if lo == hi:
+        return _data > lo, offset
+    counts, edges = np.histogram(_data, bins=256, range=(lo, hi))
+    return _data > _otsu(counts, edges, zeros, lo), offset
+
+
+def segment_points_tiled(
+    img, roi, params, tile=tiling.TILE_SIZE, workers=None, verbose=False
+):
+    """Point segmentation of a masked image processed in tiles
+
+    Same result as point_segmentation without the area percentile filter,
+    but only a few tiles of tile x tile pixels are processed at the same
+    time. The gaussian filter reads a halo around every tile, Otsu's
+    threshold is computed on the sum of the histograms of the tiles and,
+    with the 'components' backend, the components of every tile are merged
+    across the seams. The 'contour' backend needs the whole foreground
+    image (uint8) of the region to follow the contours, and only tiles the
+    floating point preprocessing.
+
+    Parameters
+    ----------
+    img
+        Channel image, can be a memory-mapped array
+    roi
+        Roi
+    params
+        Dict of parameters (see POINT_PARAMS)
+    tile, optional
+        Size of the tiles, by default tiling.TILE_SIZE
+    workers, optional
+        Amount of tiles processed at the same time
+
+    Returns
+    -------
+        Structured array of points (see POINT_DTYPE) in full frame coordinates
+    """
+
+    p, s, mode = params["percentile"], params["sigma"], params["mode"]
+    size = (params["min_size"], params["max_size"])
+    ratio = (params["min_ratio"], params["max_ratio"])
+    n = int(np.prod(roi.shape))
+    inner = tiling.grow(roi.slices, int(4.0 * s + 0.5), roi.shape)
+    tiles = tiling.tile_slices(inner, tile)
+    zeros = n - int(np.prod([sl.stop - sl.start for sl in inner]))
+
+    u = tiled_masked_percentile(img, roi, n, p, tile, workers)
+
+    def extent(core):
+        res = _blur(img, roi, core, u, s)
+        return res.min(), res.max()
+
+    def histogram(core):
+        return np.histogram(_blur(img, roi, core, u, s), bins=256, range=(lo, hi))[0]
+
+    # Otsu's threshold of the whole frame needs its range first, and then its
+    # histogram. Tiles are blurred again in every pass instead of being kept
+    th = None
+    if mode == "Otsu":
+        extents = [e for row in tiling.map_tiles(extent, tiles, workers) for e in row]
+        lo = min(e[0] for e in extents)
+        hi = max(e[1] for e in extents)
+        lo, hi = (min(lo, 0), max(hi, 0)) if zeros > 0 else (lo, hi)
+        if lo == hi:
+            th = lo
+        else:
+            counts = tiling.map_tiles(histogram, tiles, workers)
+            counts = sum(c for row in counts for c in row)
+            edges = np.histogram_bin_edges(np.zeros(1), bins=256, range=(lo, hi))
+            th = _otsu(counts, edges, zeros, lo)
+
+    def foreground(core):
+        res = _blur(img, roi, core, u, s)
+        res = res if th is None else res > th
+        return np.array(res * 255, dtype="uint8")
+
+    if params["backend"] == "components":
+        points = _segment_components_tiled(foreground, tiles, size, ratio, workers)
+    else:
+        fg = np.zeros([sl.stop - sl.start for sl in inner], dtype="uint8")
+
+        def write(core):
+            fg[tiling.local(core, inner)] = foreground(core)
+
+        tiling.map_tiles(write, tiles, workers)
+        points, _ = _segment_contours(fg, size, ratio, verbose)
+        points["axis-0"] += inner[0].start
+        points["axis-1"] += inner[1].start
     return points
+
+
+def _segment_components_tiled(foreground, tiles, size, ratio, workers=None):
+    """Components of the foreground of every tile, merged across seams"""
+
+    import cv2
+
+    def label(core):
+        fg = foreground(core)
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(
+            fg, connectivity=8, ltype=cv2.CV_32S
+        )
+        rows = np.repeat(np.arange(core[0].start, core[0].stop), fg.shape[1])
+        cols = np.tile(np.arange(core[1].start, core[1].stop), fg.shape[0])
+        flat = labels.ravel()
+        return {
+            "n": n - 1,
+            "area": stats[1:, cv2.CC_STAT_AREA].astype(np.float64),
+            "sum_r": np.bincount(flat, weights=rows, minlength=n)[1:],
+            "sum_c": np.bincount(flat, weights=cols, minlength=n)[1:],
+            "top": stats[1:, cv2.CC_STAT_TOP] + core[0].start,
+            "left": stats[1:, cv2.CC_STAT_LEFT] + core[1].start,
+            "bottom": stats[1:, cv2.CC_STAT_TOP]
+            + stats[1:, cv2.CC_STAT_HEIGHT]
+            + core[0].start,
+            "right": stats[1:, cv2.CC_STAT_LEFT]
+            + stats[1:, cv2.CC_STAT_WIDTH]
+            + core[1].start,
+            "edges": tiling.tile_edges(labels),
+        }
+
+    results = tiling.map_tiles(label, tiles, workers)
+    if sum(res["n"] for row in results for res in row) == 0:
+        return np.empty(0, dtype=POINT_DTYPE)
+
+    # Labels of every tile are numbered after the labels of the previous tiles
+    offsets, total = {}, 0
+    for r, row in enumerate(results):
+        for c, res in enumerate(row):
+            offsets[(r, c)] = total - 1  # local label 1 is the first one
+            total += res["n"]
+
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for a, b, kind in tiling.tile_seams(tiles):
+        pair = tiling.edge_pairs(
+            results[a[0]][a[1]]["edges"], results[b[0]][b[1]]["edges"], kind
+        )
+        pairs.append(pair + np.array([offsets[a], offsets[b]]))
+    objects = tiling.merge_labels(total, np.concatenate(pairs))
+    n_objects = int(objects.max()) + 1
+
+    def gather(key):
+        return np.concatenate(
+            [res[key] for row in results for res in row] + [np.empty(0)]
+        )
+
+    area = np.bincount(objects, weights=gather("area"), minlength=n_objects)
+    sum_r = np.bincount(objects, weights=gather("sum_r"), minlength=n_objects)
+    sum_c = np.bincount(objects, weights=gather("sum_c"), minlength=n_objects)
+    bounds = {}
+    for key, init, reduce in (
+        ("top", np.inf, np.minimum),
+        ("left", np.inf, np.minimum),
+        ("bottom", -np.inf, np.maximum),
+        ("right", -np.inf, np.maximum),
+    ):
+        bounds[key] = np.full(n_objects, init)
+        reduce.at(bounds[key], objects, gather(key))
+
+    width = bounds["right"] - bounds["left"]
+    height = bounds["bottom"] - bounds["top"]
+    # Same centroids as cv2.connectedComponentsWithStats on the whole image
+    centroids = np.stack([sum_c / area, sum_r / area], axis=1)
+    return _component_points(area, width, height, centroids, size, ratio)
+
+
+def point_segmentation_many(images, params, mask=None, workers=None, tile=None):
+    """Runs point_segmentation on several channels concurrently
+
+    Parameters
+    ----------
+    images
+        List of channel images
+    params
+        List of parameter dicts, one per image
+    mask, optional
+        Boolean mask or Roi, shared by all images. By default None
+    workers, optional
+        Amount of threads, by default one per image
+    tile, optional
+        Size of the tiles, see point_segmentation. Tiled channels are
+        processed one after the other, with workers tiles at the same time.
+        By default None (not tiled)
+
+    Returns
+    -------
+        List of structured arrays of points, one per image
+    """
+
+    if mask is not None and not isinstance(mask, Roi):
+        mask = Roi(mask)
+    if tile != None:
+        return [
+            point_segmentation(img, prm, mask, tile=tile, workers=workers)
+            for img, prm in zip(images, params)
+        ]
+
+    workers = len(images) if workers == None else workers
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(
+            executor.map(
+                lambda args: point_segmentation(args[0], args[1], mask),
+                zip(images, params),
+            )
+        )
@@ -0,0 +1,131 @@
+"""Import time budget
+
+This module measures the startup cost of HIPO with `python -X importtime`.
+GUI and image libraries (napari, OpenCV, scikit-image, tifffile, ...) are
+imported inside the functions that use them, so commands that only read
+manifests, like listing samples, start fast. The check fails if one of
+these libraries is imported at startup again, or if the total import time
+exceeds a budget.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+measure_imports
+    Import time of every module imported by a statement
+check_imports
+    Checks the import time and the heavy modules imported at startup
+"""
+import os
+import sys
+import subprocess
+
+# Libraries that must only be imported by the operations that use them
+HEAVY_MODULES = [
+    "napari",
+    "magicgui",
+    "qtpy",
+    "PyQt5",
+    "tkinter",
+    "skimage",
+    "cv2",
+    "tifffile",
+    "PIL",
+    "scipy",
+    "dask",
+]
+# Import time budget of the startup of HIPO (ms)
+BUDGET_MS = 1000
+STARTUP_STATEMENT = "import main"
+
+
+def measure_imports(statement=STARTUP_STATEMENT):
+    """Import time of every module imported by a statement
+
+    The statement is run in a new interpreter, from the root of the
+    repository, so modules already imported by the caller are measured too.
+
+    Parameters
+    ----------
+    statement, optional
+        Python statement, by default STARTUP_STATEMENT
+
+    Returns
+    -------
+        List of (module, depth, self time, cumulative time) tuples, times in
+        ms, in import order. depth is 0 for modules imported by the statement
+        and grows with every nested import
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=root,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"'{statement}' failed: {proc.stderr.strip()}")
+
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if not fields[0].strip().isdigit():
+            # Header line
+            continue
+        # Nested imports are indented by two spaces per level
+        name = fields[2][1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append(
+            (name.strip(), depth, int(fields[0]) / 1000, int(fields[1]) / 1000)
+        )
+    return modules
+
+
+def check_imports(statement=STARTUP_STATEMENT, budget=BUDGET_MS, top=10):
+    """Checks the import time and the heavy modules imported by a statement
+
+    Parameters
+    ----------
+    statement, optional
+        Python statement, by default STARTUP_STATEMENT
+    budget, optional
+        Maximum total import time (ms), by default BUDGET_MS
+    top, optional
+        Amount of slowest modules reported, by default 10
+
+    Returns
+    -------
+        Dict with the total import time ('total', ms), the slowest modules
+        ('top', list of (module, cumulative ms)), the heavy modules imported
+        ('heavy') and the list of errors ('errors', empty if the check passed)
+    """
+
+    modules = measure_imports(statement)
+    # The cumulative time of a module includes its nested imports
+    total = sum(cumulative for _, depth, _, cumulative in modules if depth == 0)
+    heavy = sorted(
+        {
+            name.split(".")[0]
+            for name, _, _, _ in modules
+            if name.split(".")[0] in HEAVY_MODULES
+        }
+    )
+    slowest = sorted(modules, key=lambda m: m[3], reverse=True)[:top]
+
+    errors = []
+    if total > budget:
+        errors.append(
+            f"Import time {total:.0f} ms exceeds the budget of {budget:.0f} ms"
+        )
+    if len(heavy) > 0:
+        errors.append(f"Heavy modules imported at startup: {', '.join(heavy)}")
+
+    return {
+        "total": total,
+        "top": [(name, cumulative) for name, _, _, cumulative in slowest],
+        "heavy": heavy,
+        "errors": errors,
+    }
@@ -4,8 +4,17 @@ Author: José Verdú-Díaz
 import numpy as np
 import pandas as pd
 
+from lib.models.Roi import Roi
+
 
 class Channel:
+    # Attributes stored in the manifest or in the points files, changing them
+    # marks the channel as dirty (see Sample.save)
+    TRACKED = ["name", "label", "th", "points", "point_params"]
+    # Image types, assigning a new image marks it as pending to be stored
+    # (see Sample.save_channels_images)
+    IMAGES = ["image", "image_norm", "image_cont", "image_thre"]
+
     def __init__(
         self,
         name: str = None,
@@ -13,14 +22,40 @@ class Channel:
         th=None,
         points=pd.DataFrame(),
         image=None,
+        n_points=None,
+        point_params=None,
     ):
         self.name = name
         self.label = label
         self.th = th
         self.points = points
+        # Stored point count, points are loaded on demand
+        self.n_points = n_points if points.empty else len(points)
+        # Parameters of the last point segmentation (see lib.image.POINT_PARAMS)
+        self.point_params = point_params
 
         self.image = image
 
+        self.dirty = set()
+
+    def __setattr__(self, name, value):
+        if name in Channel.TRACKED:
+            self.__dict__.setdefault("dirty", set()).add(name)
+        if name == "points":
+            self.__dict__["n_points"] = None if value.empty else len(value)
+            # The spatial index of the previous points is no longer valid
+            self.__dict__.pop("point_index", None)
+        if name in Channel.IMAGES and value is not None:
+            self.__dict__.setdefault("dirty_images", set()).add(name)
+        super().__setattr__(name, value)
+
+    def is_dirty(self):
+        return len(getattr(self, "dirty", set())) > 0
+
+    def clean(self):
+        self.dirty = set()
+        return self
+
     ####################################################################
     ################### LOADING AND SAVING FUNCTIONS ###################
     ####################################################################
@@ -30,8 +65,18 @@ class Channel:
 
     def load_images(self, im_type="image", img=None):
         setattr(self, im_type, img)
+        getattr(self, "dirty_images", set()).discard(im_type)
         return self
 
+    def count_points(self):
+        """Returns the amount of points, without needing them to be loaded"""
+
+        # use getattr for compatibility with older HIPO versions
+        points = getattr(self, "points", pd.DataFrame())
+        if not points.empty:
+            return len(points)
+        return getattr(self, "n_points", None)
+
     def dump_images(self):
         """Dumps all images of the channel
 
@@ -39,7 +84,8 @@ class Channel:
         -------
             Channel
         """
-        self.image = None
+        self.__dict__["image"] = None
+        getattr(self, "dirty_images", set()).discard("image")
         return self
 
     ####################################################################
@@ -47,23 +93,35 @@ class Channel:
     ####################################################################
 
     def apply_mask(self, mask, img=None):
-        if isinstance(img, np.ndarray):
-            return np.where(mask, img, 0)
-        else:
-            return np.where(mask, self.image, 0)
+        """Sets the pixels outside the mask to 0
+
+        Parameters
+        ----------
+        mask
+            Boolean mask or Roi. With a Roi only its bounding box is processed
+        img, optional
+            Image to mask, by default the channel image
+        """
+
+        img = img if isinstance(img, np.ndarray) else self.image
+        if isinstance(mask, Roi):
+            return mask.apply(img)
+        return np.where(mask, img, 0)
 
     ####################################################################
     ############################ ANALYSIS ##############################
     ####################################################################
 
     def analyse(self, mask):
-        mask_positive = np.logical_and(mask, self.image >= self.th)
-        positive_pixels = self.image[mask_positive]
-        all_pixels = self.image[mask]
+        if isinstance(mask, Roi):
+            all_pixels = mask.pixels(self.image)
+        else:
+            all_pixels = self.image[mask]
+        positive_pixels = all_pixels[all_pixels >= self.th]
         mean_positive = np.mean(positive_pixels)
-        area_positive = np.sum(mask_positive)
+        area_positive = positive_pixels.size
         mean_all = np.mean(all_pixels)
-        area_all = np.sum(mask)
+        area_all = all_pixels.size
         positive_fraction = float(area_positive) / float(area_all)
         summary_dict = {
             "Channel": self.name,
@@ -0,0 +1,361 @@
+"""Per-channel image store
+
+This module contains the class ChannelStore, used to store the images of
+a sample as one numpy binary file (.npy) per channel. Uncompressed channels
+can be opened with mmap_mode, so accessing a single channel only reads the
+pages of that channel instead of inflating a whole .npz archive. Channels
+can also be compressed with one of the stdlib codecs (zlib, lzma, bz2),
+using several threads.
+
+Author: José Verdú-Díaz
+"""
+import io
+import os
+import re
+import bz2
+import json
+import lzma
+import time
+import zlib
+import hashlib
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Default codec of every image type. Raw images are kept uncompressed so they
+# can be memory-mapped, derived images are compressed.
+DEFAULT_CODECS = {"image": "none"}
+DEFAULT_CODEC = "zlib:6"
+
+CODEC_OPT = ["none", "zlib:1", "zlib:6", "zlib:9", "lzma", "bz2"]
+CODEC_EXT = {"none": ".npy", "zlib": ".npy.zlib", "lzma": ".npy.xz", "bz2": ".npy.bz2"}
+
+
+def parse_codec(codec: str):
+    """Splits a codec string ('zlib:6', 'lzma', ...) into name and level"""
+
+    name, _, level = codec.partition(":")
+    if name not in CODEC_EXT:
+        raise ValueError(f"Unknown codec {codec}, options are {list(CODEC_EXT)}")
+    return name, int(level) if level else None
+
+
+def encode(img: np.ndarray, codec: str) -> bytes:
+    """Serializes an array as .npy bytes compressed with a codec"""
+
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(img))
+    name, level = parse_codec(codec)
+    if name == "zlib":
+        return zlib.compress(buffer.getbuffer(), 6 if level == None else level)
+    elif name == "lzma":
+        return lzma.compress(buffer.getbuffer(), preset=level)
+    elif name == "bz2":
+        return bz2.compress(buffer.getbuffer(), 9 if level == None else level)
+    return buffer.getvalue()
+
+
+def array_hash(img: np.ndarray) -> str:
+    """sha256 of the dtype, shape and data of an array, independent of codec"""
+
+    img = np.ascontiguousarray(img)
+    h = hashlib.sha256(f"{img.dtype.str}{img.shape}".encode())
+    h.update(memoryview(img).cast("B"))
+    return h.hexdigest()
+
+
+def decode(data: bytes, codec: str) -> np.ndarray:
+    name, _ = parse_codec(codec)
+    if name == "zlib":
+        data = zlib.decompress(data)
+    elif name == "lzma":
+        data = lzma.decompress(data)
+    elif name == "bz2":
+        data = bz2.decompress(data)
+    return np.load(io.BytesIO(data))
+
+
+class ChannelStore:
+    """Directory with one array per channel and an index file
+
+    The store of an image type lives in samples/{sample}/{im_type}/ and
+    contains an index.json file mapping channel names to their files,
+    codecs, dtypes, shapes and content hashes.
+
+    Parameters
+    ----------
+    sample
+        Name of the sample
+    im_type, optional
+        Type of image, by default 'image'
+    codec, optional
+        Codec used to write new channels ('none', 'zlib:N', 'lzma', 'bz2').
+        If None, the codec of the existing store or the default codec of
+        the image type is used. By default None
+    workers, optional
+        Amount of threads used to compress channels, by default os.cpu_count()
+    path, optional
+        Directory of the store, by default samples/{sample}/{im_type}
+    """
+
+    VERSION = 2
+    INDEX = "index.json"
+
+    def __init__(
+        self,
+        sample: str,
+        im_type: str = "image",
+        codec: str = None,
+        workers: int = None,
+        path: str = None,
+    ):
+        self.sample = sample
+        self.im_type = im_type
+        self.path = f"samples/{sample}/{im_type}" if path == None else path
+        self.index = self._read_index()
+        if codec != None:
+            parse_codec(codec)
+            self.index["codec"] = codec
+        self.codec = self.index.get("codec", DEFAULT_CODECS.get(im_type, DEFAULT_CODEC))
+        self.workers = os.cpu_count() if workers == None else workers
+
+    ####################################################################
+    ########################## INDEX HANDLING ##########################
+    ####################################################################
+
+    def _read_index(self):
+        if os.path.isfile(f"{self.path}/{self.INDEX}"):
+            with open(f"{self.path}/{self.INDEX}", "r") as f:
+                return json.load(f)
+        return {"version": self.VERSION, "channels": {}}
+
+    def flush(self):
+        """Writes the index file of the store"""
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp = f"{self.path}/{self.INDEX}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(tmp, f"{self.path}/{self.INDEX}")
+
+    @staticmethod
+    def file_name(channel: str, codec: str = "none") -> str:
+        """Returns a file system safe name for a channel"""
+        return re.sub(r"[^\w.-]", "_", channel) + CODEC_EXT[parse_codec(codec)[0]]
+
+    ####################################################################
+    ######################### READING / WRITING ########################
+    ####################################################################
+
+    def exists(self) -> bool:
+        return len(self.index["channels"]) > 0
+
+    def keys(self) -> list:
+        return list(self.index["channels"].keys())
+
+    def __contains__(self, channel: str) -> bool:
+        return channel in self.index["channels"]
+
+    def read(self, channel: str, mmap_mode="r"):
+        """Reads the image of a channel
+
+        Parameters
+        ----------
+        channel
+            Name of the channel
+        mmap_mode, optional
+            Passed to np.load, by default 'r'. Use None to load the
+            whole array in memory. Ignored for compressed channels, which
+            are always decompressed in memory
+
+        Returns
+        -------
+            numpy array (or memmap), None if the channel is not stored
+        """
+
+        if channel not in self:
+            return None
+        entry = self.index["channels"][channel]
+        codec = entry.get("codec", "none")
+        if codec == "none":
+            return np.load(f"{self.path}/{entry['file']}", mmap_mode=mmap_mode)
+        with open(f"{self.path}/{entry['file']}", "rb") as f:
+            return decode(f.read(), codec)
+
+    def digest(self, channel: str) -> str:
+        """Content hash of a channel (see array_hash), None if not stored
+
+        The hash is computed when the channel is written. Channels written
+        by older HIPO versions are hashed on first use and the hash is added
+        to the index.
+        """
+
+        if channel not in self:
+            return None
+        entry = self.index["channels"][channel]
+        if entry.get("hash") == None:
+            entry["hash"] = array_hash(self.read(channel))
+            self.flush()
+        return entry["hash"]
+
+    def _write_file(self, channel: str, img: np.ndarray) -> dict:
+        """Writes a channel file and returns its index entry
+
+        The array is written to a temporary file and moved into place, so
+        readers never see a partially written channel. Runs in the worker
+        threads of write_many.
+        """
+
+        name = self.file_name(channel, self.codec)
+        tmp = f"{self.path}/{name}.tmp"
+        with open(tmp, "wb") as f:
+            if self.codec == "none":
+                np.save(f, np.asarray(img))
+            else:
+                f.write(encode(img, self.codec))
+        os.replace(tmp, f"{self.path}/{name}")
+        return {
+            "file": name,
+            "codec": self.codec,
+            "dtype": str(img.dtype),
+            "shape": list(img.shape),
+            "hash": array_hash(img),
+        }
+
+    def _add_entry(self, channel: str, entry: dict):
+        old = self.index["channels"].get(channel)
+        if old != None and old["file"] != entry["file"]:
+            if os.path.isfile(f"{self.path}/{old['file']}"):
+                os.remove(f"{self.path}/{old['file']}")
+        self.index["channels"][channel] = entry
+
+    def write(self, channel: str, img: np.ndarray, flush: bool = True):
+        """Writes the image of a single channel"""
+
+        os.makedirs(self.path, exist_ok=True)
+        self._add_entry(channel, self._write_file(channel, img))
+        if flush:
+            self.flush()
+
+    def delete(self, channel: str, flush: bool = True):
+        """Removes the image of a single channel from the store"""
+
+        if channel not in self:
+            return
+        entry = self.index["channels"].pop(channel)
+        if os.path.isfile(f"{self.path}/{entry['file']}"):
+            os.remove(f"{self.path}/{entry['file']}")
+        if flush:
+            self.flush()
+
+    def write_many(self, images):
+        """Writes several channels, compressing them concurrently
+
+        Parameters
+        ----------
+        images
+            Dictionary or iterable of (channel, image) pairs. Iterables are
+            consumed lazily, keeping at most two images per worker in memory
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+        if isinstance(images, dict):
+            images = images.items()
+
+        if self.codec == "none" or self.workers <= 1:
+            for channel, img in images:
+                self.write(channel, img, flush=False)
+            self.flush()
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for channel, img in images:
+                pending.append(
+                    (channel, executor.submit(self._write_file, channel, img))
+                )
+                if len(pending) >= 2 * self.workers:
+                    channel, future = pending.pop(0)
+                    self._add_entry(channel, future.result())
+            for channel, future in pending:
+                self._add_entry(channel, future.result())
+        self.flush()
+
+    ####################################################################
+    ############################ MIGRATION #############################
+    ####################################################################
+
+    def migrate_npz(self, remove: bool = True) -> bool:
+        """Converts a legacy samples/{sample}/{im_type}.npz archive
+
+        Every channel of the archive is inflated once and written to the
+        store. The archive is removed afterwards unless remove is False.
+
+        Returns
+        -------
+            True if an archive was migrated, False otherwise
+        """
+
+        npz_path = f"samples/{self.sample}/{self.im_type}.npz"
+        if not os.path.isfile(npz_path):
+            return False
+
+        with np.load(npz_path) as img_stack:
+            self.write_many((c, img_stack[c]) for c in img_stack.files)
+
+        if remove:
+            os.remove(npz_path)
+        return True
+
+
+def benchmark_codecs(images: dict, codecs: list = CODEC_OPT, workers: int = None):
+    """Reports the size versus speed tradeoff of every codec
+
+    The images are written to and read back from a temporary store with
+    every codec.
+
+    Parameters
+    ----------
+    images
+        Dictionary of channel name and image
+    codecs, optional
+        List of codecs to test, by default CODEC_OPT
+    workers, optional
+        Amount of compression threads, by default os.cpu_count()
+
+    Returns
+    -------
+        List of dicts with the keys Codec, Size (MB), Ratio, Write (s) and
+        Read (s), one per codec
+    """
+
+    raw_size = sum(np.asarray(img).nbytes for img in images.values())
+    result = []
+    for codec in codecs:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = ChannelStore(None, codec=codec, workers=workers, path=tmp)
+
+            start = time.perf_counter()
+            store.write_many(images)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for channel in store.keys():
+                np.asarray(store.read(channel, mmap_mode=None))
+            read_time = time.perf_counter() - start
+
+            size = sum(
+                os.path.getsize(f"{tmp}/{e['file']}")
+                for e in store.index["channels"].values()
+            )
+
+        result.append(
+            {
+                "Codec": codec,
+                "Size (MB)": round(size / 1e6, 2),
+                "Ratio": round(raw_size / size, 2),
+                "Write (s)": round(write_time, 3),
+                "Read (s)": round(read_time, 3),
+            }
+        )
+    return result
@@ -0,0 +1,126 @@
+"""Sample manifest
+
+This module contains the class Manifest, a small versioned json file with
+the metadata of a sample (name, channels, thresholds, pixel ranges, point
+counts, image size, the hashes of the input files and the key of the
+mask). It only depends on the standard library, so the
+channel table of a sample can be read without unpickling any image, mask
+or points data.
+
+Author: José Verdú-Díaz
+"""
+import os
+import json
+
+
+class Manifest:
+    VERSION = 1
+    FILE = "manifest.json"
+
+    def __init__(
+        self,
+        name,
+        description=None,
+        img_size=None,
+        channels=None,
+        mask_key=None,
+        inputs=None,
+    ):
+        self.name = name
+        self.description = description
+        self.img_size = img_size
+        # Hash of the geojson file and image size the mask was built from
+        self.mask_key = mask_key
+        # Hashes of the input files, keyed by type (txt, geojson, tiff)
+        self.inputs = inputs
+        # List of dicts with the keys name, label, th, min, max, points and
+        # point_params
+        self.channels = channels
+
+    @staticmethod
+    def path(name):
+        return f"samples/{name}/{Manifest.FILE}"
+
+    @staticmethod
+    def exists(name):
+        return os.path.isfile(Manifest.path(name))
+
+    @staticmethod
+    def ingested(name):
+        """True if the sample has a manifest with channels
+
+        make_dir_structure writes the manifest before the channels are
+        created, so a sample whose ingest failed has a manifest without
+        channels and can be ingested again.
+        """
+
+        try:
+            manifest = Manifest.load(name)
+        except (OSError, ValueError, KeyError):
+            return False
+        return manifest != None and manifest.channels != None
+
+    ####################################################################
+    ################### LOADING AND SAVING FUNCTIONS ###################
+    ####################################################################
+
+    @classmethod
+    def load(cls, name):
+        """Reads the manifest of a sample
+
+        Returns
+        -------
+            Manifest, None if the sample has no manifest
+        """
+
+        if not Manifest.exists(name):
+            return None
+        with open(Manifest.path(name), "r") as f:
+            data = json.load(f)
+        return cls.from_dict(data)
+
+    def save(self):
+        """Writes the manifest atomically"""
+
+        path = Manifest.path(self.name)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(f"{path}.tmp", path)
+
+    def to_dict(self):
+        return {
+            "version": self.VERSION,
+            "name": self.name,
+            "description": self.description,
+            "img_size": None if self.img_size == None else list(self.img_size),
+            "channels": self.channels,
+            "mask_key": self.mask_key,
+            "inputs": self.inputs,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        img_size = data.get("img_size")
+        return cls(
+            name=data["name"],
+            description=data.get("description"),
+            img_size=None if img_size == None else tuple(img_size),
+            channels=data.get("channels"),
+            mask_key=data.get("mask_key"),
+            inputs=data.get("inputs"),
+        )
+
+    ####################################################################
+    ############################## UTILS ###############################
+    ####################################################################
+
+    def channel_names(self):
+        return [] if self.channels == None else [c["name"] for c in self.channels]
+
+    def find_channel(self, key):
+        """Returns the channel entry with a given name or label, None if missing"""
+
+        for c in [] if self.channels == None else self.channels:
+            if key == c["name"] or key == c["label"]:
+                return c
+        return None
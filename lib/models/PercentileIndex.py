@@ -0,0 +1,83 @@
+"""Sorted-value index of an image
+
+This module contains the class PercentileIndex, which sorts the values of
+an image once so percentiles can be looked up with a binary search, and
+thresholded previews can be updated touching only the pixels whose state
+changes between two thresholds.
+
+Author: José Verdú-Díaz
+"""
+import numpy as np
+
+
+class PercentileIndex:
+    def __init__(self, data):
+        data = np.asarray(data)
+        self.shape = data.shape
+        self.order = np.argsort(data, axis=None, kind="stable")
+        self.values = data.ravel()[self.order]
+
+        # Thresholded preview and amount of pixels set to 0 in it
+        self._preview = None
+        self._below = 0
+
+    ####################################################################
+    ############################# LOOKUPS ##############################
+    ####################################################################
+
+    def percentile(self, p):
+        """Returns the same value as np.percentile(data, p)
+
+        Uses the 'linear' method of np.percentile on the sorted values, so no
+        partial sort of the image is needed.
+        """
+
+        n = self.values.size
+        virtual = np.float64(p) / 100 * (n - 1)
+        lo = int(np.floor(virtual))
+        hi = min(lo + 1, n - 1)
+        gamma = float(virtual - lo)
+        a, b = self.values[lo], self.values[hi]
+        diff = b - a
+        if gamma >= 0.5:
+            return b - diff * (1 - gamma)
+        return a + diff * gamma
+
+    def rank(self, th):
+        """Returns the amount of values below a threshold"""
+
+        return int(np.searchsorted(self.values, th, side="left"))
+
+    def percentile_of(self, th):
+        """Returns the percentile (0-100) of a threshold value"""
+
+        return 100 * self.rank(th) / self.values.size
+
+    ####################################################################
+    ############################# PREVIEWS #############################
+    ####################################################################
+
+    def threshold(self, th):
+        """Returns np.where(data < th, 0, data), updated incrementally
+
+        The preview is kept between calls. Moving the threshold only writes
+        the pixels whose value lies between the previous and the new
+        threshold. A copy of the preview is returned, so arrays returned by
+        previous calls (e.g. the data of a napari layer) don't change.
+        """
+
+        if self._preview is None:
+            self._preview = np.empty(self.values.size, dtype=self.values.dtype)
+            self._preview[self.order] = self.values
+            self._below = 0
+
+        below = self.rank(th)
+        if below > self._below:
+            self._preview[self.order[self._below : below]] = 0
+        elif below < self._below:
+            self._preview[self.order[below : self._below]] = self.values[
+                below : self._below
+            ]
+        self._below = below
+
+        return self._preview.reshape(self.shape).copy()
@@ -0,0 +1,381 @@
+"""Spatial index of the points of a channel
+
+This module contains the class PointIndex, a KD-tree over the positions
+(axis-0, axis-1) of a set of points. It answers radius, nearest neighbour,
+bounding box and region queries for many query points at once, so
+neighbourhood statistics don't need to compare every pair of points.
+
+Author: José Verdú-Díaz
+"""
+import os
+import numpy as np
+import pickle as pkl
+
+
+class PointIndex:
+    VERSION = 1
+    # Average amount of points per cell of the grid used by the box queries
+    GRID_POINTS = 8
+    # Boxes processed at once by the box queries
+    BOX_CHUNK = 1 << 16
+
+    def __init__(self, coords, source=None):
+        """
+        Parameters
+        ----------
+        coords
+            Array (n x 2) of point positions (axis-0, axis-1)
+        source, optional
+            Identifier of the file the points were read from, used to detect
+            stale indexes (see lib.cache.source_key). By default None
+        """
+
+        from scipy.spatial import cKDTree
+
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.source = source
+        self.tree = cKDTree(self.coords)
+        # Points sorted by axis-0, used by the bounding box queries
+        self.order = np.argsort(self.coords[:, 0], kind="stable")
+        self.sorted_rows = self.coords[self.order, 0]
+
+    @classmethod
+    def from_points(cls, points, source=None):
+        """Builds the index of a points DataFrame (or structured array)"""
+
+        if len(points) == 0:
+            return cls(np.empty((0, 2)), source)
+        return cls(np.stack([points["axis-0"], points["axis-1"]], axis=1), source)
+
+    def __len__(self):
+        return len(self.coords)
+
+    ####################################################################
+    ################### LOADING AND SAVING FUNCTIONS ###################
+    ####################################################################
+
+    def save(self, path):
+        """Stores the index atomically"""
+
+        with open(f"{path}.tmp", "wb") as file:
+            pkl.dump((self.VERSION, self), file)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path, source=None):
+        """Loads a stored index
+
+        Returns
+        -------
+            PointIndex, None if it doesn't exist, was stored by another
+            version or was built from a different source
+        """
+
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as file:
+            version, index = pkl.load(file)
+        if version != cls.VERSION or index.source != source:
+            return None
+        return index
+
+    ####################################################################
+    ############################# QUERIES ##############################
+    ####################################################################
+
+    def radius(self, centers, r):
+        """Points within a distance of every center
+
+        Parameters
+        ----------
+        centers
+            Array (m x 2) of positions
+        r
+            Radius, or array of m radii
+
+        Returns
+        -------
+            List of m arrays with the indices of the points
+        """
+
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        res = self.tree.query_ball_point(centers, r, workers=-1)
+        return [np.array(i, dtype=np.int64) for i in res]
+
+    def count_radius(self, centers, r):
+        """Amount of points within a distance of every center"""
+
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        return np.asarray(
+            self.tree.query_ball_point(centers, r, workers=-1, return_length=True),
+            dtype=np.int64,
+        )
+
+    def knn(self, centers, k=1):
+        """k nearest points of every center
+
+        Returns
+        -------
+            Arrays (m x k) of distances and indices. Missing neighbours (if
+            there are less than k points) have distance inf and index len(self)
+        """
+
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        dist, idx = self.tree.query(centers, k=[i + 1 for i in range(k)], workers=-1)
+        return dist, idx
+
+    def box(self, lo, hi):
+        """Points inside a bounding box, lo <= position < hi
+
+        Parameters
+        ----------
+        lo, hi
+            Corners (axis-0, axis-1) of the box
+
+        Returns
+        -------
+            Array with the indices of the points
+        """
+
+        start = np.searchsorted(self.sorted_rows, lo[0], side="left")
+        stop = np.searchsorted(self.sorted_rows, hi[0], side="left")
+        candidates = self.order[start:stop]
+        cols = self.coords[candidates, 1]
+        return np.sort(candidates[(cols >= lo[1]) & (cols < hi[1])])
+
+    def grid(self):
+        """Uniform grid of square cells over the points, built on first use
+
+        Cells hold GRID_POINTS points on average. Points are sorted by cell
+        (row-major), so the points of consecutive cells of a row of the grid
+        are contiguous.
+
+        Returns
+        -------
+            Dict with the origin and size of the cells, the shape of the
+            grid, the order of the points ('order'), the position of the
+            first point of every cell in that order ('offsets', one more
+            than cells) and the cumulative point counts of the cells
+            ('cumulative', shape + 1, the amount of points in the cells of
+            rows < i and columns < j)
+        """
+
+        if self.__dict__.get("_grid") == None:
+            origin = self.coords.min(axis=0) if len(self) > 0 else np.zeros(2)
+            extent = self.coords.max(axis=0) - origin if len(self) > 0 else np.ones(2)
+            area = np.prod(np.maximum(extent, 1.0))
+            size = float(np.sqrt(area * self.GRID_POINTS / max(len(self), 1)))
+            shape = (np.floor(extent / size).astype(np.int64) + 1).tolist()
+
+            cells = np.floor((self.coords - origin) / size).astype(np.int64)
+            counts = np.zeros(shape, dtype=np.int64)
+            np.add.at(counts, (cells[:, 0], cells[:, 1]), 1)
+            cumulative = np.zeros((shape[0] + 1, shape[1] + 1), dtype=np.int64)
+            cumulative[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+            self._grid = {
+                "origin": origin,
+                "size": size,
+                "shape": shape,
+                "order": np.argsort(
+                    cells[:, 0] * shape[1] + cells[:, 1], kind="stable"
+                ),
+                "offsets": np.concatenate([[0], np.cumsum(counts.ravel())]),
+                "cumulative": cumulative,
+            }
+        return self._grid
+
+    def _cells(self, x, axis):
+        """Cell of a coordinate along an axis, -1 and shape below and above"""
+
+        g = self.grid()
+        cell = np.floor((x - g["origin"][axis]) / g["size"])
+        return np.clip(cell, -1, g["shape"][axis]).astype(np.int64)
+
+    @staticmethod
+    def _expand(first, count):
+        """Concatenation of the ranges [first, first + count)
+
+        Returns
+        -------
+            Array with the values of all ranges, and array with the range
+            each value belongs to
+        """
+
+        count = np.maximum(count, 0)
+        owner = np.repeat(np.arange(len(count)), count)
+        ends = np.cumsum(count)
+        values = np.arange(ends[-1] if len(ends) > 0 else 0)
+        return values + np.repeat(first - (ends - count), count), owner
+
+    def _in_cells(self, lo, hi, box, rows, cols):
+        """Points of several ranges of cells that are inside their box
+
+        Parameters
+        ----------
+        lo, hi
+            Arrays (m x 2) with the corners of the boxes
+        box, rows
+            Box and row of the grid of every range of cells
+        cols
+            Tuple of arrays with the first and last column of every range
+
+        Returns
+        -------
+            Arrays with the box and the index of the point of every match
+        """
+
+        g = self.grid()
+        first = rows * g["shape"][1]
+        start = g["offsets"][first + np.maximum(cols[0], 0)]
+        stop = g["offsets"][first + np.minimum(cols[1], g["shape"][1] - 1) + 1]
+        pos, owner = self._expand(start, stop - start)
+        box, points = box[owner], g["order"][pos]
+        rows, cols = self.coords[points, 0], self.coords[points, 1]
+        inside = (
+            (rows >= lo[box, 0])
+            & (rows < hi[box, 0])
+            & (cols >= lo[box, 1])
+            & (cols < hi[box, 1])
+        )
+        return box[inside], points[inside]
+
+    def _box_cells(self, lo, hi):
+        """First and last row and column of the cells of every box, clipped
+        to the grid. Empty if last < first"""
+
+        g = self.grid()
+        i0 = np.maximum(self._cells(lo[:, 0], 0), 0)
+        i1 = np.minimum(self._cells(hi[:, 0], 0), g["shape"][0] - 1)
+        j0 = np.maximum(self._cells(lo[:, 1], 1), 0)
+        j1 = np.minimum(self._cells(hi[:, 1], 1), g["shape"][1] - 1)
+        empty = (i1 < i0) | (j1 < j0)
+        i1[empty] = i0[empty] - 1
+        return i0, i1, j0, j1
+
+    def boxes(self, lo, hi):
+        """Points inside several bounding boxes, see box
+
+        Only the points of the cells of the grid (see grid) covered by every
+        box are checked, with a single vectorized pass for BOX_CHUNK boxes.
+
+        Parameters
+        ----------
+        lo, hi
+            Arrays (m x 2) with the corners of the boxes
+
+        Returns
+        -------
+            List of m arrays with the indices of the points
+        """
+
+        lo = np.asarray(lo, dtype=np.float64).reshape(-1, 2)
+        hi = np.asarray(hi, dtype=np.float64).reshape(-1, 2)
+        if len(self) == 0:
+            return [np.empty(0, dtype=np.int64) for _ in range(len(lo))]
+
+        result = []
+        for start in range(0, len(lo), self.BOX_CHUNK):
+            chunk = slice(start, start + self.BOX_CHUNK)
+            i0, i1, j0, j1 = self._box_cells(lo[chunk], hi[chunk])
+            # Every row of cells of a box is a contiguous range of points
+            rows, box = self._expand(i0, i1 - i0 + 1)
+            box, points = self._in_cells(
+                lo[chunk], hi[chunk], box, rows, (j0[box], j1[box])
+            )
+            order = np.lexsort((points, box))
+            splits = np.cumsum(np.bincount(box, minlength=len(i0)))[:-1]
+            result += np.split(points[order], splits)
+        return result
+
+    def count_boxes(self, lo, hi):
+        """Amount of points inside several bounding boxes, see box
+
+        The cells fully inside a box are counted with the cumulative counts
+        of the grid (see grid), and only the points of the cells on the
+        border of the box are checked, so the cost depends on the perimeter
+        of the boxes and not on their area.
+        """
+
+        lo = np.asarray(lo, dtype=np.float64).reshape(-1, 2)
+        hi = np.asarray(hi, dtype=np.float64).reshape(-1, 2)
+        if len(self) == 0:
+            return np.zeros(len(lo), dtype=np.int64)
+
+        cumulative = self.grid()["cumulative"]
+        result = []
+        for start in range(0, len(lo), self.BOX_CHUNK):
+            chunk = slice(start, start + self.BOX_CHUNK)
+            i0, i1, j0, j1 = self._box_cells(lo[chunk], hi[chunk])
+            m = len(i0)
+
+            # Inner cells, rows i0 + 1 to i1 - 1 and columns j0 + 1 to j1 - 1
+            a, b = np.minimum(i0 + 1, i1), np.minimum(j0 + 1, j1)
+            a, b, i, j = (np.maximum(x, 0) for x in (a, b, i1, j1))
+            counts = (
+                cumulative[i, j]
+                - cumulative[a, j]
+                - cumulative[i, b]
+                + cumulative[a, b]
+            )
+
+            # Border cells: first and last rows, and first and last columns of
+            # the rows in between
+            top = np.flatnonzero(i1 >= i0)
+            bottom = np.flatnonzero(i1 > i0)
+            rows, middle = self._expand(i0 + 1, i1 - i0 - 1)
+            right = np.flatnonzero(j1[middle] > j0[middle])
+            box = np.concatenate([top, bottom, middle, middle[right]])
+            rows = np.concatenate([i0[top], i1[bottom], rows, rows[right]])
+            first = np.concatenate([j0[top], j0[bottom], j0[middle], j1[middle[right]]])
+            last = np.concatenate([j1[top], j1[bottom], j0[middle], j1[middle[right]]])
+            box, _ = self._in_cells(lo[chunk], hi[chunk], box, rows, (first, last))
+            result.append(counts + np.bincount(box, minlength=m))
+        return np.concatenate(result) if len(result) > 0 else np.zeros(0, np.int64)
+
+    def count_regions(self, labels):
+        """Amount of points inside every region of a label image
+
+        Parameters
+        ----------
+        labels
+            Label image, points are assigned to the label of their pixel
+
+        Returns
+        -------
+            Array with the amount of points of every label, from 0 to the
+            maximum label
+        """
+
+        n = int(np.max(labels)) + 1 if np.size(labels) > 0 else 0
+        if len(self) == 0:
+            return np.zeros(n, dtype=np.int64)
+        pos = np.floor(self.coords).astype(np.int64)
+        inside = (
+            (pos[:, 0] >= 0)
+            & (pos[:, 0] < labels.shape[0])
+            & (pos[:, 1] >= 0)
+            & (pos[:, 1] < labels.shape[1])
+        )
+        pos = pos[inside]
+        return np.bincount(np.asarray(labels[pos[:, 0], pos[:, 1]]), minlength=n)
+
+    ####################################################################
+    ###################### NEIGHBOURHOOD STATISTICS ####################
+    ####################################################################
+
+    def pairs(self, r):
+        """Array (m x 2) of the pairs of points (i < j) within a distance r"""
+
+        return self.tree.query_pairs(r, output_type="ndarray")
+
+    def neighbour_counts(self, r):
+        """Amount of other points within a distance of every point"""
+
+        return self.count_radius(self.coords, r) - 1
+
+    def nearest_distances(self, k=1):
+        """Distance from every point to its k-th nearest other point"""
+
+        dist, _ = self.knn(self.coords, k + 1)
+        return dist[:, -1]
@@ -0,0 +1,111 @@
+"""Region of interest of a sample
+
+This module contains the class Roi, which precomputes the bounding box of
+a mask, the mask cropped to it and the flat indices of the pixels inside
+it, so mask dependent operations only process the bounding box.
+
+Author: José Verdú-Díaz
+"""
+import numpy as np
+
+
+class Roi:
+    def __init__(self, mask=None):
+        if mask is None:
+            return
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape
+
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if rows.size == 0:
+            self.bbox = (0, 0, 0, 0)
+        else:
+            self.bbox = (
+                int(rows[0]),
+                int(rows[-1]) + 1,
+                int(cols[0]),
+                int(cols[-1]) + 1,
+            )
+
+        self.mask = mask[self.slices]
+        self._indices = None
+
+    @property
+    def slices(self):
+        """Slices of the bounding box (rows, columns)"""
+        return slice(self.bbox[0], self.bbox[1]), slice(self.bbox[2], self.bbox[3])
+
+    @property
+    def offset(self):
+        """Position (row, column) of the bounding box in the full frame"""
+        return self.bbox[0], self.bbox[2]
+
+    @property
+    def area(self):
+        return int(np.count_nonzero(self.mask))
+
+    @property
+    def indices(self):
+        """Flat indices of the in-mask pixels, relative to the bounding box"""
+
+        if self._indices is None:
+            self._indices = np.flatnonzero(self.mask)
+        return self._indices
+
+    ####################################################################
+    ################### LOADING AND SAVING FUNCTIONS ###################
+    ####################################################################
+
+    def save(self, path):
+        np.savez(
+            path,
+            shape=np.array(self.shape),
+            bbox=np.array(self.bbox),
+            mask=self.mask,
+            indices=self.indices,
+        )
+
+    @classmethod
+    def load(cls, path):
+        roi = cls()
+        with np.load(path) as data:
+            roi.shape = tuple(int(x) for x in data["shape"])
+            roi.bbox = tuple(int(x) for x in data["bbox"])
+            roi.mask = data["mask"]
+            roi._indices = data["indices"]
+        return roi
+
+    ####################################################################
+    ######################### IMAGE PROCESSING #########################
+    ####################################################################
+
+    def contains(self, rows, cols):
+        """Whether the pixels at some positions are inside the mask"""
+
+        rows = np.asarray(rows) - self.bbox[0]
+        cols = np.asarray(cols) - self.bbox[2]
+        inside = (
+            (rows >= 0)
+            & (rows < self.mask.shape[0])
+            & (cols >= 0)
+            & (cols < self.mask.shape[1])
+        )
+        res = np.zeros(rows.shape, dtype=bool)
+        res[inside] = self.mask[rows[inside], cols[inside]]
+        return res
+
+    def crop(self, img):
+        """Crops an image to the bounding box"""
+        return img[self.slices]
+
+    def pixels(self, img):
+        """Returns the in-mask pixels of an image, in the same order as img[mask]"""
+        return np.asarray(self.crop(img))[self.mask]
+
+    def apply(self, img):
+        """Returns np.where(mask, img, 0), only processing the bounding box"""
+
+        cropped = np.where(self.mask, self.crop(img), 0)
+        out = np.zeros(self.shape, dtype=cropped.dtype)
+        out[self.slices] = cropped
+        return out
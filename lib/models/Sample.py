@@ -4,27 +4,49 @@ Author: José Verdú-Díaz
 import os
 import gc
 import json
-import napari
 import numpy as np
 import pandas as pd
 import pickle as pkl
 from tqdm import tqdm
-import tifffile as tf
+from contextlib import contextmanager
 import tabulate as tblt
-from magicgui import magicgui
-from PIL import Image as PIL_Image
 from datetime import datetime as dtm
-from napari.layers import Points, Image
-from PIL import ImageDraw as PIL_ImageDraw
-from skimage.filters._gaussian import gaussian
-from napari.types import ImageData, LayerDataTuple
-from skimage.filters.thresholding import threshold_otsu
 
 from lib.models.Channel import Channel
+from lib.models.ChannelStore import ChannelStore, array_hash
+from lib.models.Manifest import Manifest
+from lib.models.PercentileIndex import PercentileIndex
+from lib.models.PointIndex import PointIndex
+from lib.models.Roi import Roi
 from lib.models.Colors import Color, Colormap
+from lib.image import POINT_PARAMS, blur_threshold, point_segmentation_many
+from lib.analysis import (
+    VERSION as ANALYSIS_VERSION,
+    analyse_channels,
+    analyse_fibers,
+    assign_points,
+    colocalization,
+    fiber_areas,
+    fiber_point_counts,
+)
+from lib.stats import channel_stats, histogram_percentile
+from lib.rasterize import geojson_key, rasterize_geojson
+from lib.cache import atomic_write, file_hash, find_sample, link_files, source_key
+from lib.pyramid import build_pyramid
 
 
 class Sample:
+    # Attributes stored in the manifest, changing them marks it as dirty
+    TRACKED = [
+        "name",
+        "description",
+        "channels",
+        "summary",
+        "img_size",
+        "mask_key",
+        "inputs",
+    ]
+
     def __init__(
         self, name=None, description=None, channels=None, summary=None, mask=None
     ):
@@ -36,24 +58,142 @@ class Sample:
         self.fiber_labels = None
         self.df = None
         self.img_size = None
+        self.mask_key = None
+        self.inputs = None
+
+    def __setattr__(self, name, value):
+        if name in Sample.TRACKED:
+            self.mark_dirty("manifest")
+        super().__setattr__(name, value)
+
+    def __setstate__(self, state):
+        # Samples pickled by older HIPO versions store the mask in the object
+        if "mask" in state:
+            state["_mask"] = state.pop("mask")
+        self.__dict__.update(state)
+
+    ####################################################################
+    ########################## DIRTY TRACKING ##########################
+    ####################################################################
+
+    def mark_dirty(self, *parts):
+        """Marks parts of the sample ('manifest', 'mask') as modified"""
+
+        self.__dict__.setdefault("_dirty", set()).update(parts)
+        return self
+
+    def is_dirty(self):
+        if len(self.__dict__.get("_dirty", set())) > 0:
+            return True
+        return self.channels != None and any(c.is_dirty() for c in self.channels)
+
+    def clean(self):
+        """Marks the sample and its channels as saved"""
+
+        self.__dict__["_dirty"] = set()
+        if self.channels != None:
+            for c in self.channels:
+                c.clean()
+        return self
+
+    @contextmanager
+    def transaction(self):
+        """Defers saving until the end of a multi-step operation
+
+        Calls to save() inside the block are no-ops; the sample is saved once
+        when the outermost transaction exits without raising.
+
+        Example
+        -------
+            with sample.transaction():
+                sample.update_df()
+                sample.save_points(opt)
+                sample.save()
+        """
+
+        self.__dict__["_transaction"] = self.__dict__.get("_transaction", 0) + 1
+        try:
+            yield self
+        finally:
+            self.__dict__["_transaction"] -= 1
+        if self.__dict__["_transaction"] == 0:
+            self.save()
+
+    @property
+    def mask(self):
+        """ROI mask, loaded from mask.npy the first time it is accessed"""
+
+        if (
+            getattr(self, "_mask", None) is None
+            and self.name != None
+            and os.path.isfile(f"samples/{self.name}/mask.npy")
+        ):
+            self._mask = np.load(f"samples/{self.name}/mask.npy")
+        return getattr(self, "_mask", None)
+
+    @mask.setter
+    def mask(self, mask):
+        self.mark_dirty("mask")
+        self._mask = mask
+        self._roi = None
+        # The mask no longer comes from a geojson file, see make_mask
+        self.__dict__["mask_key"] = None
+
+    @property
+    def roi(self):
+        """Roi (bounding box, cropped mask and indices) of the mask
+
+        Cached in roi.npz, which is rebuilt when it is older than mask.npy or
+        when the mask was modified and not saved yet.
+        """
+
+        if getattr(self, "_roi", None) == None and self.mask is not None:
+            path = f"samples/{self.name}/roi.npz"
+            if (
+                "mask" not in self.__dict__.get("_dirty", set())
+                and os.path.isfile(path)
+                and os.path.getmtime(path)
+                >= os.path.getmtime(f"samples/{self.name}/mask.npy")
+            ):
+                self._roi = Roi.load(path)
+            else:
+                self._roi = Roi(self.mask)
+                if os.path.isdir(f"samples/{self.name}"):
+                    # roi.npz can be hard-linked by other samples (see lib.cache)
+                    with atomic_write(path, "wb") as f:
+                        self._roi.save(f)
+        return getattr(self, "_roi", None)
 
     ####################################################################
     ################### LOADING AND SAVING FUNCTIONS ###################
     ####################################################################
 
-    def make_dir_structure(self):
-        """Creates the directory and file structure for a new sample"""
+    def make_dir_structure(self, exist_ok=False):
+        """Creates the directory and file structure for a new sample
+
+        Parameters
+        ----------
+        exist_ok, optional
+            Allow the sample directory to exist, e.g. when it only contains
+            the input files. By default False
+        """
 
         path = f"samples/{self.name}"
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=exist_ok)
 
         with open("lib/json/sample_dir_structure.json", "r") as f:
             data = json.load(f)
         for d in data:
-            os.makedirs(f"{path}/{d}")
+            os.makedirs(f"{path}/{d}", exist_ok=exist_ok)
 
         self.save()
 
+    def points_path(self, opt: int):
+        return f"samples/{self.name}/points/{self.name}_{self.channels[opt].label}_points.csv"
+
+    def point_index_path(self, opt: int):
+        return self.points_path(opt).replace("_points.csv", "_points_index.pkl")
+
     def save_points(self, opt: int = None):
         if (
             isinstance(opt, int)
@@ -61,34 +201,185 @@ class Sample:
             and not self.channels[opt].points.empty
         ):
             os.makedirs(f"samples/{self.name}/points/", exist_ok=True)
-            self.channels[opt].points.to_csv(
-                f"samples/{self.name}/points/{self.name}_{self.channels[opt].label}_points.csv"
-            )
+            self.channels[opt].points.to_csv(self.points_path(opt))
+            if os.path.isfile(self.point_index_path(opt)):
+                os.remove(self.point_index_path(opt))
+            # Points are up to date on disk, only the point count is pending
+            getattr(self.channels[opt], "dirty", set()).discard("points")
+            self.mark_dirty("manifest")
+
+    def load_points(self, opt: int):
+        """Loads the points of a channel from its csv file, if not loaded yet"""
+
+        c = self.channels[opt]
+        if getattr(c, "points", pd.DataFrame()).empty and c.count_points():
+            if os.path.isfile(self.points_path(opt)):
+                c.points = pd.read_csv(self.points_path(opt), index_col=0)
+                c.dirty.discard("points")
+        return self
+
+    def point_index(self, opt: int):
+        """Returns the spatial index of the points of a channel (see PointIndex)
+
+        The index is built on first use and stored next to the points csv
+        file. A stored index is reused while the csv file doesn't change.
+        """
+
+        c = self.channels[opt]
+        if getattr(c, "point_index", None) != None:
+            return c.point_index
+
+        self.load_points(opt)
+        points = getattr(c, "points", pd.DataFrame())
+        # Points not saved yet are indexed but not stored
+        stored = "points" not in getattr(c, "dirty", set())
+        source = source_key(self.points_path(opt)) if stored else None
+
+        index = None
+        if source != None:
+            index = PointIndex.load(self.point_index_path(opt), source)
+        if index == None:
+            index = PointIndex.from_points(points, source)
+            if source != None:
+                index.save(self.point_index_path(opt))
+        c.__dict__["point_index"] = index
+        return index
 
     def save(self):
-        """Stores a pickle file with the Sample object
+        """Stores the modified parts of the sample
 
-        Stores the current Sample object as a pickle binary file. Removes the channel
-        images before creating the file, as they make the binary file extremely large.
-        These images should be stored in compressed numpy binary files using the
+        Stores the metadata of the current Sample object in the manifest file
+        (see Manifest), the mask as a numpy binary file and the points of the
+        channels in csv files, writing only the parts that changed since the
+        last save. Saving a clean sample, or saving inside a transaction(), is
+        a no-op. Channel images are stored in the channel store using the
         save_channels_images() method.
         """
 
+        if self.__dict__.get("_transaction", 0) > 0 or not self.is_dirty():
+            return
+
         clr = Color()
-        print(f"{clr.GREY}Saving sample, this can take some seconds...{clr.ENDC}")
-        self.dump_channels_images()
+        print(f"{clr.GREY}Saving sample...{clr.ENDC}")
         path = f"samples/{self.name}"
-        with open(f"{path}/sample.pkl", "wb") as file:
-            pkl.dump(self, file)
+        dirty = self.__dict__.get("_dirty", set())
+
+        if "mask" in dirty and isinstance(getattr(self, "_mask", None), np.ndarray):
+            # Replaced atomically, the files can be hard-linked by other
+            # samples (see lib.cache)
+            with atomic_write(f"{path}/mask.npy", "wb") as f:
+                np.save(f, self._mask)
+            with atomic_write(f"{path}/roi.npz", "wb") as f:
+                Roi(self._mask).save(f)
+
+        if self.channels != None:
+            for i, c in enumerate(self.channels):
+                if "points" in getattr(c, "dirty", set()):
+                    if c.points.empty:
+                        for stale in (self.points_path(i), self.point_index_path(i)):
+                            if os.path.isfile(stale):
+                                os.remove(stale)
+                    self.save_points(i)
+                if c.is_dirty():
+                    dirty.add("manifest")
+
+        if "manifest" in dirty:
+            self.manifest().save()
+
+        self.clean()
+
+    def manifest(self):
+        """Returns the Manifest with the metadata of the sample"""
+
+        channels = None
+        if self.channels != None:
+            pixel_min = self.summary["MinValue"].tolist()
+            pixel_max = self.summary["MaxValue"].tolist()
+            channels = [
+                {
+                    "name": c.name,
+                    "label": c.label,
+                    "th": None if c.th == None else float(c.th),
+                    "min": float(pixel_min[i]),
+                    "max": float(pixel_max[i]),
+                    "points": c.count_points(),
+                    # use getattr for compatibility with older HIPO versions
+                    "point_params": getattr(c, "point_params", None),
+                }
+                for i, c in enumerate(self.channels)
+            ]
+
+        return Manifest(
+            name=self.name,
+            description=self.description,
+            img_size=self.img_size,
+            channels=channels,
+            # use getattr for compatibility with older HIPO versions
+            mask_key=getattr(self, "mask_key", None),
+            inputs=getattr(self, "inputs", None),
+        )
+
+    @classmethod
+    def from_manifest(cls, manifest):
+        sample = cls(name=manifest.name, description=manifest.description)
+        sample.img_size = manifest.img_size
+        sample.mask_key = manifest.mask_key
+        sample.inputs = manifest.inputs
+        if manifest.channels != None:
+            sample.channels = [
+                Channel(
+                    name=c["name"],
+                    label=c["label"],
+                    th=c["th"],
+                    n_points=c["points"],
+                    point_params=c.get("point_params"),
+                )
+                for c in manifest.channels
+            ]
+            sample.summary = pd.DataFrame(
+                {
+                    "Channel": [c["name"] for c in manifest.channels],
+                    "Label": [c["label"] for c in manifest.channels],
+                    "MinValue": [c["min"] for c in manifest.channels],
+                    "MaxValue": [c["max"] for c in manifest.channels],
+                }
+            )
+            sample.update_df(save=False)
+        return sample.clean()
 
     def load(self, txt_path=None, geojson_path=None, tiff_path=None):
-        path = f"samples/{self.name}"
-        with open(f"{path}/sample.pkl", "rb") as file:
-            self = pkl.load(file)
+        manifest = Manifest.load(self.name)
+        if manifest == None:
+            self = self.migrate_pickle()
+        else:
+            self = Sample.from_manifest(manifest)
         res = self.create_channels(txt_path, geojson_path, tiff_path)
 
         return res, self
 
+    def migrate_pickle(self):
+        """Converts a sample.pkl file stored by older HIPO versions
+
+        The pickled Sample is loaded once, its points and mask are stored in
+        their own files and its metadata in the manifest. The pickle file is
+        removed afterwards.
+        """
+
+        clr = Color()
+        print(f"{clr.GREY}Migrating sample.pkl to manifest...{clr.ENDC}")
+        path = f"samples/{self.name}"
+        with open(f"{path}/sample.pkl", "rb") as file:
+            sample = pkl.load(file)
+        sample.name = self.name
+
+        sample.mark_dirty("manifest", "mask")
+        if sample.channels != None:
+            for i in range(len(sample.channels)):
+                sample.save_points(i)
+        sample.save()
+        os.remove(f"{path}/sample.pkl")
+        return sample
+
     def create_channels(self, txt_path=None, geojson_path=None, tiff_path=None):
         if self.channels == None:
             clr = Color()
@@ -99,66 +390,122 @@ class Sample:
                 )
                 return 0
 
-            while True:  # Is his really needed???
-                images, channels, labels, summary = self.parse_tiff(tiff_path, txt_path)
+            # The hash of the geojson file is added by make_mask
+            self.inputs = {"txt": file_hash(txt_path), "tiff": file_hash(tiff_path)}
+            # Samples ingested from the same files share the channel store
+            source = find_sample(
+                lambda m: m.inputs != None
+                and m.inputs.get("tiff") == self.inputs["tiff"]
+                and m.inputs.get("txt") == self.inputs["txt"]
+                and m.channels != None,
+                files=[f"image/{ChannelStore.INDEX}"],
+                exclude=self.name,
+            )
+            if source != None:
+                channels, labels, summary = self.link_channels(source, txt_path)
+            else:
+                channels, labels, summary = self.ingest_tiff(tiff_path, txt_path)
 
-                self.img_size = images[
-                    0
-                ].shape  # We assume the same size for all input images
+            self.summary = summary.sort_values(["Channel"]).reset_index(drop=True)
 
-                self.summary = summary.sort_values(["Channel"]).reset_index(drop=True)
+            self.channels = [
+                Channel(name=c, label=l)
+                for c, l in sorted(zip(channels, labels), key=lambda x: x[0])
+            ]
 
-                df = (
-                    pd.DataFrame(
-                        list(zip(images, channels, labels)),
-                        columns=["Image", "Channel", "Label"],
-                    )
-                    .sort_values(["Channel"])
-                    .reset_index(drop=True)
-                )
+            self.make_mask(geojson_path)
+            self.save()
+            # Statistics depend on the channel images and on the mask
+            if source == None or not self.link_stats(source):
+                self.compute_stats()
+            self.update_df()
 
-                self.channels = []
-                for i, c in enumerate(df["Channel"].to_list()):
-                    self.channels.append(
-                        Channel(
-                            name=c,
-                            label=df["Label"].to_list()[i],
-                            image=df["Image"].to_list()[i],
-                        )
-                    )
+            return 1
 
-                self.save_channels_images(im_type="image")
-                self.make_mask(geojson_path)
-                self.save()
-                self.update_df()
+    def link_channels(self, source, summary_path):
+        """Reuses the channel store of a sample ingested from the same files
 
-                return 1
+        The files of the store are hard-linked (see lib.cache) instead of
+        parsing and writing the tiff file again.
+
+        Returns
+        -------
+            Lists of channel names and labels (in tiff order) and the summary
+            DataFrame, as ingest_tiff
+        """
+
+        clr = Color()
+        print(f"{clr.GREY}Reusing channel images of sample {source}...{clr.ENDC}")
+        summary_df = pd.read_csv(summary_path, sep="\t")
+        manifest = Manifest.load(source)
+        link_files(f"samples/{source}/image", f"samples/{self.name}/image")
+        self.img_size = manifest.img_size
+
+        n = len(manifest.channels)
+        channels = [str(summary_df["Channel"][i]) for i in range(n)]
+        labels = [str(summary_df["Label"][i]) for i in range(n)]
+        labels = [l if not l == "nan" else "-" for l in labels]
+        return channels, labels, summary_df
+
+    def link_stats(self, source):
+        """Reuses the statistics of a sample with the same images and mask
+
+        Returns
+        -------
+            True if the statistics were reused
+        """
+
+        manifest = Manifest.load(source)
+        files = ["stats.json", "stats_hist.npz"]
+        if manifest.mask_key != self.mask_key or not all(
+            os.path.isfile(f"samples/{source}/{f}") for f in files
+        ):
+            return False
+        link_files(f"samples/{source}", f"samples/{self.name}", files)
+        return True
+
+    def image_store(self, im_type="image"):
+        """Returns the ChannelStore of an image type
+
+        Legacy {im_type}.npz archives are migrated to the per-channel store
+        the first time they are accessed.
+        """
+
+        store = ChannelStore(self.name, im_type)
+        if not store.exists() and os.path.isfile(f"samples/{self.name}/{im_type}.npz"):
+            clr = Color()
+            print(f"{clr.GREY}Migrating {im_type}.npz to channel store...{clr.ENDC}")
+            store.migrate_npz()
+            store = ChannelStore(self.name, im_type)
+        return store
+
+    def has_images(self, im_type="image"):
+        return self.image_store(im_type).exists()
 
     def load_channels_images(self, im_type="image", options=None):
         clr = Color()
-        if os.path.isfile(f"samples/{self.name}/{im_type}.npz"):
-            img_stack = np.load(f"samples/{self.name}/{im_type}.npz")
-        else:
+        store = self.image_store(im_type)
+        if not store.exists():
             return None
 
         if isinstance(options, int):
             print(f"{clr.GREY}Loading {im_type}...{clr.ENDC}")
             self.channels[options] = self.channels[options].load_images(
-                im_type=im_type, img=img_stack[self.channels[options].name]
+                im_type=im_type, img=store.read(self.channels[options].name)
             )
         elif isinstance(options, list):
             for opt in tqdm(
                 options, desc=f"{clr.GREY}Loading selected channels", postfix=clr.ENDC
             ):
                 self.channels[opt] = self.channels[opt].load_images(
-                    im_type=im_type, img=img_stack[self.channels[opt].name]
+                    im_type=im_type, img=store.read(self.channels[opt].name)
                 )
         else:
             for c in tqdm(
                 self.channels, desc=f"{clr.GREY}Loading {im_type}", postfix=clr.ENDC
             ):
-                if c.name in img_stack.keys():
-                    c = c.load_images(im_type=im_type, img=img_stack[c.name])
+                if c.name in store:
+                    c = c.load_images(im_type=im_type, img=store.read(c.name))
         return self
 
     def load_fiber_labels(self):
@@ -176,6 +523,8 @@ class Sample:
         clr = Color()
         print(f"{clr.GREY}Importing lables...{clr.ENDC}")
         if ftype == "tiff":
+            import tifffile as tf
+
             labels = tf.TiffFile(path).asarray()
         elif ftype == "npz":
             labels = np.load(path)["arr_0"]
@@ -189,18 +538,28 @@ class Sample:
         else:
             return None
 
-    def save_channels_images(self, im_type=None):
-        """Saves channel images in compressed numpy binary files (.npz)
+    def save_channels_images(self, im_type=None, options=None, codec=None):
+        """Saves channel images in the per-channel image store
 
-        This method provides a way of storing channel images in a compressed format,
-        allowing for a more compact file system. All images or a single image type
-        can be stored using the im_type parameter.
+        This method stores every channel image as its own numpy binary file
+        (see ChannelStore), so single channels can later be memory-mapped.
+        All images or a single image type can be stored using the im_type
+        parameter. Only the selected channels are written, the rest of the
+        channels of the image type are left untouched.
 
         Parameters
         ----------
         im_type, optional
             Type of image to store. Options are 'image', 'image_norm', 'image_cont'
             and None. If None, all image types are stored. By default None
+        options, optional
+            Index (int) or list of indexes of the channels to store. If None,
+            the channels whose image changed since it was loaded are stored.
+            By default None
+        codec, optional
+            Codec of the image type ('none', 'zlib:N', 'lzma', 'bz2'), see
+            ChannelStore. If None, the current codec of the image type is
+            kept. By default None
         """
 
         if self.channels != None:
@@ -208,28 +567,127 @@ class Sample:
             IM_TYPE_OPT = ["image", "image_norm", "image_cont"]
             save_list = [im_type] if im_type != None else IM_TYPE_OPT
             for s in save_list:
+                if isinstance(options, int):
+                    opts = [options]
+                elif isinstance(options, list):
+                    opts = options
+                else:
+                    opts = [
+                        i
+                        for i, c in enumerate(self.channels)
+                        if s in getattr(c, "dirty_images", set())
+                    ]
+                if len(opts) == 0:
+                    continue
+
+                store = ChannelStore(self.name, s, codec=codec)
                 images = {}
-                for c in tqdm(
-                    self.channels, desc=f"{clr.GREY}Saving {s}", postfix=clr.ENDC
-                ):
-                    if isinstance(getattr(c, s), np.ndarray):
+                for opt in opts:
+                    c = self.channels[opt]
+                    if isinstance(getattr(c, s, None), np.ndarray):
                         images[c.name] = getattr(c, s)
-                print(f"{clr.GREY}Compressing images file...{clr.ENDC}")
-                np.savez_compressed(f"samples/{self.name}/{s}.npz", **images)
+                        getattr(c, "dirty_images", set()).discard(s)
+                print(f"{clr.GREY}Saving {s} ({store.codec})...{clr.ENDC}")
+                store.write_many(images)
+
+    def delete_channels_images(self, im_type, options):
+        """Removes the images of the selected channels from the store
+
+        Parameters
+        ----------
+        im_type
+            Type of image to remove
+        options
+            Index (int) or list of indexes of the channels
+        """
 
-    def parse_tiff(self, tiff_path, summary_path):
-        tiff_slices = tf.TiffFile(tiff_path).asarray()
+        opts = [options] if isinstance(options, int) else options
+        store = self.image_store(im_type)
+        for opt in opts:
+            store.delete(self.channels[opt].name, flush=False)
+            setattr(self.channels[opt], im_type, None)
+        store.flush()
+
+    def ingest_tiff(self, tiff_path, summary_path, codec=None):
+        """Streams the channels of a tiff file into the image store
+
+        The tiff file is read one page (channel) at a time and every page is
+        written straight to the ChannelStore, so the whole multi-channel stack
+        is never held in memory. Uncompressed pages are memory-mapped instead
+        of read, bounding the peak memory to a single channel.
+
+        Parameters
+        ----------
+        tiff_path
+            Path to the multi-channel tiff file
+        summary_path
+            Path to the summary (.txt) file
+        codec, optional
+            Codec of the raw images, see ChannelStore. By default None, which
+            keeps them uncompressed and memory-mappable
+
+        Returns
+        -------
+            Lists of channel names and labels (in tiff order) and the summary
+            DataFrame
+        """
+
+        clr = Color()
         channels, labels = [], []
 
         summary_df = pd.read_csv(summary_path, sep="\t")
+        store = ChannelStore(self.name, "image", codec=codec)
+
+        # Image libraries are imported on use, see lib.importtime
+        import tifffile as tf
+
+        with tf.TiffFile(tiff_path) as tif:
+            series = tif.series[0]
+            pages = list(series.pages)
+            if len(pages) == 1 and len(series.shape) == 3:
+                # All channels in a single page, slice it along the first axis
+                stack = self._read_tiff_page(tiff_path, pages[0])
+                slices = (stack[i] for i in range(stack.shape[0]))
+                n_slices = stack.shape[0]
+            else:
+                slices = (self._read_tiff_page(tiff_path, p) for p in pages)
+                n_slices = len(pages)
+
+            def named_slices():
+                for slice, img in enumerate(
+                    tqdm(
+                        slices,
+                        total=n_slices,
+                        desc=f"{clr.GREY}Ingesting channels",
+                        postfix=clr.ENDC,
+                    )
+                ):
+                    channel = str(summary_df["Channel"][slice])
+                    channels.append(channel)
+
+                    label = str(summary_df["Label"][slice])
+                    labels.append(label if not label == "nan" else "-")
 
-        for slice in range(tiff_slices.shape[0]):
-            channels.append(str(summary_df["Channel"][slice]))
+                    # We assume the same size for all input images
+                    self.img_size = img.shape
+                    yield channel, img
 
-            label = str(summary_df["Label"][slice])
-            labels.append(label if not label == "nan" else "-")
+            store.write_many(named_slices())
 
-        return tiff_slices, channels, labels, summary_df
+        return channels, labels, summary_df
+
+    @staticmethod
+    def _read_tiff_page(tiff_path, page):
+        """Memory-maps a tiff page if it is uncompressed, reads it otherwise"""
+
+        if getattr(page, "is_memmappable", False):
+            import tifffile as tf
+
+            try:
+                return tf.memmap(tiff_path, page=page.index, mode="r")
+            except ValueError:
+                pass
+        return page.asarray()
 
     def dump_channels_images(self):
         if self.channels != None:
@@ -242,11 +700,200 @@ class Sample:
                 c = c.dump_images()
         return self
 
+    def compute_stats(self, options=None):
+        """Computes and stores the statistics of the channels
+
+        Statistics (see lib.stats) are computed over the whole image and over
+        the pixels inside the mask, and stored in stats.json. The cumulative
+        histograms are stored in stats_hist.npz.
+
+        Parameters
+        ----------
+        options, optional
+            Index (int) or list of indexes of the channels. If None, all
+            channels are computed. By default None
+        """
+
+        clr = Color()
+        store = self.image_store("image")
+        if self.channels == None or not store.exists():
+            return None
+
+        if isinstance(options, int):
+            options = [options]
+        elif options == None:
+            options = list(range(len(self.channels)))
+
+        stats = self.load_stats()
+        hist_path = f"samples/{self.name}/stats_hist.npz"
+        histograms = dict(np.load(hist_path)) if os.path.isfile(hist_path) else {}
+
+        roi = self.roi
+        for opt in tqdm(
+            options, desc=f"{clr.GREY}Computing statistics", postfix=clr.ENDC
+        ):
+            name = self.channels[opt].name
+            stats[name], hist = channel_stats(store.read(name), roi)
+            for region in hist:
+                histograms[f"{name}:{region}:edges"] = hist[region][0]
+                histograms[f"{name}:{region}:cdf"] = hist[region][1]
+
+        # Both files can be hard-linked by other samples (see lib.cache)
+        with atomic_write(f"samples/{self.name}/stats.json") as f:
+            json.dump(stats, f, indent=4)
+        with atomic_write(hist_path, "wb") as f:
+            np.savez(f, **histograms)
+        self._stats = stats
+        return stats
+
+    def load_stats(self):
+        """Returns the stored statistics of the channels, keyed by channel name"""
+
+        if getattr(self, "_stats", None) == None:
+            path = f"samples/{self.name}/stats.json"
+            if os.path.isfile(path):
+                with open(path, "r") as f:
+                    self._stats = json.load(f)
+            else:
+                self._stats = {}
+        return self._stats
+
+    def channel_stats(self, opt: int, region="mask"):
+        """Returns the statistics of a channel, computing them if missing
+
+        Parameters
+        ----------
+        opt
+            Index of the channel
+        region, optional
+            'image' for the whole image or 'mask' for the pixels inside the
+            mask, by default 'mask'
+        """
+
+        stats = self.load_stats()
+        if region not in stats.get(self.channels[opt].name, {}):
+            stats = self.compute_stats(opt)
+            if stats == None:
+                return None
+        return stats[self.channels[opt].name].get(region)
+
+    def channel_histogram(self, opt: int, region="mask"):
+        """Returns the bin edges and cumulative counts of a channel histogram"""
+
+        if self.channel_stats(opt, region) == None:
+            return None
+        name = self.channels[opt].name
+        with np.load(f"samples/{self.name}/stats_hist.npz") as hist:
+            return hist[f"{name}:{region}:edges"], hist[f"{name}:{region}:cdf"]
+
+    def channel_percentile(self, opt: int, p: float, region="mask"):
+        """Looks up a percentile of a channel in its stored cumulative histogram
+
+        The lookup is a binary search on the histogram, no pixel data is
+        loaded. The result is accurate up to the width of a histogram bin.
+        """
+
+        hist = self.channel_histogram(opt, region)
+        return None if hist == None else histogram_percentile(hist[0], hist[1], p)
+
+    def channel_range(self, opt: int, region="mask"):
+        """Returns the (min, max) pixel values of a channel
+
+        Taken from the stored statistics. If they are missing (e.g. the
+        images were not stored) or the region is empty, the range of the
+        channel dtype is returned instead, or the range of the summary for
+        floating point channels.
+        """
+
+        stats = self.channel_stats(opt, region)
+        if stats != None and stats.get("max") != None:
+            return stats["min"], stats["max"]
+
+        c = self.channels[opt]
+        dtype = None
+        if getattr(c, "image", None) is not None:
+            dtype = c.image.dtype
+        else:
+            store = ChannelStore(self.name, "image")
+            if c.name in store:
+                dtype = np.dtype(store.index["channels"][c.name]["dtype"])
+        if dtype != None and np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            return int(info.min), int(info.max)
+        return (
+            float(self.summary["MinValue"].iloc[opt]),
+            float(self.summary["MaxValue"].iloc[opt]),
+        )
+
+    def pyramid(self, key):
+        """Multiscale levels of an image, for display
+
+        Downsampled levels (see lib.pyramid) are built the first time an
+        image is shown and stored uncompressed in samples/{name}/pyramid/,
+        one ChannelStore per level, so they are memory-mapped afterwards.
+        They are rebuilt when the source image changes.
+
+        Parameters
+        ----------
+        key
+            Channel index, 'm' for the mask or 'l' for the fiber labels
+
+        Returns
+        -------
+            List of levels, the first one being the full resolution image
+        """
+
+        path = f"samples/{self.name}/pyramid"
+        if key == "m":
+            name, method, img = "_mask", "nearest", self.mask
+            source = self.mask_hash()
+        elif key == "l":
+            name, method, img = "_labels", "nearest", self.fiber_labels
+            # Size and modification time, as a list to compare it with json
+            source = source_key(f"samples/{self.name}/fiber_labels.npz")
+            source = None if source == None else list(source)
+        else:
+            c = self.channels[key]
+            store = self.image_store("image")
+            name, method = c.name, "mean"
+            img = c.image if isinstance(c.image, np.ndarray) else store.read(c.name)
+            source = store.digest(c.name)
+
+        sources = {}
+        if os.path.isfile(f"{path}/sources.json"):
+            with open(f"{path}/sources.json", "r") as f:
+                sources = json.load(f)
+
+        entry = sources.get(name, {})
+        stores = [
+            ChannelStore(self.name, "pyramid", path=f"{path}/{i + 1}")
+            for i in range(entry.get("levels", 0))
+        ]
+        if source != None and entry.get("source") == source:
+            if all(name in store for store in stores):
+                return [img] + [store.read(name) for store in stores]
+
+        clr = Color()
+        print(f"{clr.GREY}Building pyramid of {name}...{clr.ENDC}")
+        levels = build_pyramid(img, method)
+        if source != None:
+            for i, level in enumerate(levels):
+                store = ChannelStore(
+                    self.name, "pyramid", codec="none", path=f"{path}/{i + 1}"
+                )
+                store.write(name, level)
+            sources[name] = {"source": source, "levels": len(levels)}
+            os.makedirs(path, exist_ok=True)
+            with open(f"{path}/sources.json.tmp", "w") as f:
+                json.dump(sources, f, indent=4)
+            os.replace(f"{path}/sources.json.tmp", f"{path}/sources.json")
+        return [img] + levels
+
     def dump_fiber_labels(self):
         self.fiber_labels = None
         return self
 
-    def update_df(self):
+    def update_df(self, save=True):
         if self.channels != None:
             clr = Color()
 
@@ -259,16 +906,16 @@ class Sample:
                 names.append(c.name)
                 labels.append(c.label)
                 thresholds.append("-" if c.th == None else c.th)
-                points.append(
-                    "-" if not hasattr(c, "points") or c.points.empty else len(c.points)
-                )
+                n_points = c.count_points()
+                points.append("-" if not n_points else n_points)
 
             self.df = pd.DataFrame(
                 list(zip(names, labels, pixel_min, pixel_max, thresholds, points)),
                 columns=["Channel", "Label", "Min", "Max", "Th.", "# points"],
             )
 
-            self.save()
+            if save:
+                self.save()
 
             return self.df
 
@@ -289,27 +936,50 @@ class Sample:
     ####################################################################
 
     def make_mask(self, geojson_file):
-        with open(geojson_file) as f:
-            annotation_data = json.load(f)
-
-        black = PIL_Image.new("1", PIL_Image.fromarray(self.channels[0].image).size)
-        imd = PIL_ImageDraw.Draw(black)
+        """Builds the mask from the annotations of a geojson file
 
-        for ann in annotation_data["features"]:
+        Polygons, holes and multi geometries are rasterized (see
+        lib.rasterize). The mask is identified by a hash of the geojson file
+        and the image size, stored in the manifest, and only rebuilt when
+        they change. The mask of another sample with the same hash is reused
+        (see lib.cache).
 
-            blob = ann["geometry"]
-
-            if blob["type"] == "LineString":
-                coords = blob["coordinates"]
-            if blob["type"] == "Polygon":
-                coords = blob["coordinates"][0]
+        Returns
+        -------
+            True if the mask was rebuilt, False if the stored one was reused
+        """
 
-            tuples = [tuple(coord) for coord in coords]
-            imd.polygon(tuples, fill="white", outline="white")
+        if getattr(self, "inputs", None) != None:
+            self.inputs = {**self.inputs, "geojson": file_hash(geojson_file)}
+        key = geojson_key(geojson_file, self.img_size)
+        if key == getattr(self, "mask_key", None) and self.mask is not None:
+            return False
 
-        self.mask = np.array(black)
+        clr = Color()
+        # Samples with the same annotations share the mask
+        source = find_sample(
+            lambda m: m.mask_key == key, files=["mask.npy"], exclude=self.name
+        )
+        if source != None:
+            print(f"{clr.GREY}Reusing mask of sample {source}...{clr.ENDC}")
+            files = ["mask.npy", "roi.npz"]
+            if not os.path.isfile(f"samples/{source}/roi.npz"):
+                files = files[:1]
+            link_files(f"samples/{source}", f"samples/{self.name}", files)
+            self.__dict__["_mask"] = None
+            self.__dict__["_roi"] = None
+            self.__dict__.get("_dirty", set()).discard("mask")
+            self.mask_key = key
+            return True
+
+        print(f"{clr.GREY}Rasterizing ROI...{clr.ENDC}")
+        self.mask = rasterize_geojson(geojson_file, self.img_size)
+        self.mask_key = key
+        return True
 
     def apply_mask(self, mask, img):
+        if isinstance(mask, Roi):
+            return mask.apply(img)
         return np.where(mask, img, 0)
 
     def threshold(self, opt=0):
@@ -346,6 +1016,13 @@ class Sample:
             If True, only one image can be selected ( len(options)==1 )
         """
 
+        # GUI libraries are only imported when a viewer is opened, so headless
+        # commands (see lib.cli) don't need a display
+        import napari
+        from magicgui import magicgui
+        from napari.layers import Points, Image
+        from napari.types import ImageData, LayerDataTuple
+
         clr = Color()
         cmap = Colormap()
 
@@ -361,44 +1038,83 @@ class Sample:
 
         viewer = napari.Viewer()
 
+        # Without widgets working on the pixel data, images are shown as
+        # multiscale pyramids and napari only reads the visible level
+        multiscale = not (threshold or point_segm or point_filter)
+
+        def levels_data(levels, masked=False):
+            """Data of a layer showing the levels of a pyramid"""
+            if masked:
+                import dask.array as da
+
+                levels = [
+                    da.where(da.from_array(m), da.from_array(l), 0)
+                    for l, m in zip(levels, self.pyramid("m"))
+                ]
+            # Images that fit the screen have a single level. The flag is
+            # passed explicitly so napari doesn't have to guess it from data
+            if len(levels) == 1:
+                return {"data": levels[0], "multiscale": False}
+            return {"data": levels, "multiscale": True}
+
+        def image_data(opt, masked):
+            if not multiscale:
+                if masked:
+                    img = self.channels[opt].apply_mask(self.roi)
+                else:
+                    img = self.channels[opt].image
+                return {"data": img, "multiscale": False}
+            return levels_data(self.pyramid(opt), masked)
+
+        def contrast_limits(opt, masked):
+            # Precomputed in stats.json, the pixels don't need to be read
+            _, high = self.channel_range(opt, region="mask" if masked else "image")
+            return [0, max(high, 0) if masked else high]
+
         layers = []
         for opt in options:
             if opt == "m":
                 layers.append(
                     viewer.add_image(
-                        self.mask, name="Mask", opacity=0.25, blending="additive"
+                        **(
+                            levels_data(self.pyramid("m"))
+                            if multiscale
+                            else {"data": self.mask, "multiscale": False}
+                        ),
+                        name="Mask",
+                        opacity=0.25,
+                        blending="additive",
+                        contrast_limits=[0, 1],
                     )
                 )
             elif opt == "l":
-                if mask:
-                    l = self.apply_mask(mask=self.mask, img=self.fiber_labels)
+                if multiscale:
+                    l = levels_data(self.pyramid("l"), mask)
+                elif mask:
+                    l = {
+                        "data": self.apply_mask(mask=self.roi, img=self.fiber_labels),
+                        "multiscale": False,
+                    }
                 else:
-                    l = self.fiber_labels
+                    l = {"data": self.fiber_labels, "multiscale": False}
                 layers.append(
                     viewer.add_labels(
-                        l, name="Fiber Labels", opacity=0.25, blending="additive"
+                        **l, name="Fiber Labels", opacity=0.25, blending="additive"
                     )
                 )
             else:
-                if mask:
-                    metadata = {"masked": True}
-                    l = self.channels[opt].apply_mask(self.mask)
-
-                else:
-                    metadata = {"masked": False}
-                    l = self.channels[opt].image
-
-                metadata["opt"] = opt
+                metadata = {"masked": mask, "opt": opt}
                 layers.append(
                     viewer.add_image(
-                        l,
+                        **image_data(opt, mask),
                         name=self.channels[opt].label,
                         blending="additive",
-                        contrast_limits=[0, l.max()],
+                        contrast_limits=contrast_limits(opt, mask),
                         colormap=cmap.next_cmap(),
                         metadata=metadata,
                     )
                 )
+                self.load_points(opt)
                 # use hasattr for compatibility with older HIPO versions
                 if (
                     hasattr(self.channels[opt], "points")
@@ -418,6 +1134,16 @@ class Sample:
                         )
                     )
 
+        # Sorted-value indexes of the images used by the widgets, built once
+        # per image so slider changes don't need to sort the image again
+        indexes = {}
+
+        def percentile_index(data):
+            if id(data) not in indexes:
+                indexes.clear()
+                indexes[id(data)] = (data, PercentileIndex(data))
+            return indexes[id(data)][1]
+
         if toggle_mask:
 
             @magicgui(
@@ -431,17 +1157,9 @@ class Sample:
                 opt = layer.metadata["opt"]
                 masked = layer.metadata["masked"]
 
-                metadata = {"opt": opt}
-
-                if masked:
-                    res = self.channels[opt].image
-                    metadata["masked"] = False
-
-                else:
-                    res = self.apply_mask(
-                        mask=self.mask, img=self.channels[opt].apply_mask(self.mask)
-                    )
-                    metadata["masked"] = True
+                metadata = {"opt": opt, "masked": not masked}
+                # The layer keeps the same amount of levels, only its data changes
+                res = image_data(opt, not masked)["data"]
 
                 return (
                     res,
@@ -489,7 +1207,9 @@ class Sample:
                 },
                 a={
                     "widget_type": "SpinBox",
-                    "max": layers[0].data.max(),
+                    "max": self.channel_range(
+                        options[0], region="mask" if mask else "image"
+                    )[1],
                     "min": 0,
                     "label": "Absolute",
                 },
@@ -499,16 +1219,19 @@ class Sample:
             def threshold(
                 data: ImageData, p: float, a: int, mode="percentile"
             ) -> ImageData:
+                index = percentile_index(data)
                 if mode == "percentile":
-                    th = np.percentile(data, p)
+                    th = index.percentile(p)
                 elif mode == "absolute":
                     th = a
                 layers[0].metadata["threshold"] = str(th)
-                return np.where(data < th, 0, data)
+                return index.threshold(th)
 
             viewer.window.add_dock_widget(threshold, area="bottom")
 
         if point_segm:
+            # Start from the parameters of the last segmentation, if any
+            params = getattr(self.channels[options[0]], "point_params", None) or {}
 
             @magicgui(
                 auto_call=True,
@@ -518,23 +1241,27 @@ class Sample:
                     "min": 97,
                     "step": 0.1,
                     "label": "Percentile",
+                    "value": np.clip(params.get("percentile", 97), 97, 100),
+                },
+                s={
+                    "widget_type": "FloatSlider",
+                    "max": 3,
+                    "min": 0,
+                    "label": "Sigma",
+                    "value": np.clip(params.get("sigma", 0), 0, 3),
                 },
-                s={"widget_type": "FloatSlider", "max": 3, "min": 0, "label": "Sigma"},
-                mode={"choices": ["None", "Otsu"]},
+                mode={"choices": ["None", "Otsu"], "value": params.get("mode", "None")},
                 layout="horizontal",
             )
             def cont_blur_thresh(
                 data: ImageData, p: float, s: float, mode="None"
             ) -> LayerDataTuple:
-                u = np.percentile(data, p)
-                _data = data / u
-                _data = np.where(_data < 1, _data, 1)
-                _data = np.array(_data * 255, dtype="uint8")
-                _data = gaussian(_data, sigma=s)
-                if mode == "None":
-                    res = _data
-                if mode == "Otsu":
-                    res = _data > threshold_otsu(_data)
+                res = blur_threshold(data, p, s, mode, index=percentile_index(data))
+                layers[0].metadata["point_params"] = {
+                    "percentile": p,
+                    "sigma": s,
+                    "mode": mode,
+                }
                 return (res, {"name": "Result", "contrast_limits": [0, res.max()]})
 
             viewer.window.add_dock_widget(cont_blur_thresh, area="bottom")
@@ -563,6 +1290,10 @@ class Sample:
                 layout="horizontal",
             )
             def filter_area(layer: Points, min: int, max: int) -> LayerDataTuple:
+                layers[0].metadata["point_params"] = {
+                    "min_area_percentile": min,
+                    "max_area_percentile": max,
+                }
                 a_min = np.percentile(list(layer.features["area"]), min)
                 a_max = np.percentile(list(layer.features["area"]), max)
                 idx = layer.features.index[
@@ -596,7 +1327,14 @@ class Sample:
 
         if threshold:
             self.channels[options[0]].th = float(layers[0].metadata["threshold"])
-        elif point_segm:
+        if point_segm or point_filter:
+            c = self.channels[options[0]]
+            c.point_params = {
+                **POINT_PARAMS,
+                **(getattr(c, "point_params", None) or {}),
+                **layers[0].metadata.get("point_params", {}),
+            }
+        if point_segm:
             return viewer.layers["Result"].data
         elif point_filter:
             return viewer.layers["Result"]
@@ -608,17 +1346,369 @@ class Sample:
 
         return self
 
+    def segment_points(self, options, params=None, workers=None, tile=None):
+        """Segments the dot-like elements of one or several channels
+
+        Headless and reproducible equivalent of the point segmentation in
+        napari_display (see lib.image.point_segmentation). Every channel is
+        segmented with its stored point_params, updated with params, and the
+        parameters used are stored in the channel. Channels are processed
+        concurrently and only inside the bounding box of the mask.
+
+        Parameters
+        ----------
+        options
+            Index or list of indexes of the channels
+        params, optional
+            Dict of parameters that override the stored ones, by default None
+        workers, optional
+            Amount of channels (or tiles, if tiled) processed at the same
+            time, by default all
+        tile, optional
+            Process every channel in tiles of this size, to bound the memory
+            used by large images, see lib.image.segment_points_tiled. By
+            default None
+
+        Returns
+        -------
+            Sample
+        """
+
+        options = [options] if isinstance(options, int) else options
+        channels = [self.channels[opt] for opt in options]
+        missing = [opt for opt, c in zip(options, channels) if c.image is None]
+        if len(missing) > 0:
+            self.load_channels_images(im_type="image", options=missing)
+
+        param_list = [
+            {
+                **POINT_PARAMS,
+                # use getattr for compatibility with older HIPO versions
+                **(getattr(c, "point_params", None) or {}),
+                **({} if params == None else params),
+            }
+            for c in channels
+        ]
+        points = point_segmentation_many(
+            [c.image for c in channels],
+            param_list,
+            mask=self.roi,
+            workers=workers,
+            tile=tile,
+        )
+
+        for c, p, prm in zip(channels, points, param_list):
+            c.points = pd.DataFrame(
+                {
+                    "index": np.arange(len(p)),
+                    "axis-0": p["axis-0"],
+                    "axis-1": p["axis-1"],
+                    "area": p["area"],
+                }
+            )
+            c.point_params = prm
+        return self
+
     ####################################################################
     ############################ ANALYSIS ##############################
     ####################################################################
 
-    def analyse(self):
-        result = []
-        for c in self.channels:
-            if isinstance(getattr(c, "image"), np.ndarray) and c.th != None:
-                result.append(c.analyse(self.mask))
-        result_df = pd.DataFrame(result)
+    def mask_hash(self):
+        """Identifier of the mask: the key of its geojson file (see make_mask)
+        or, for masks not built from a geojson file, the hash of the mask"""
+
+        if getattr(self, "mask_key", None) != None:
+            return self.mask_key
+        return None if self.mask is None else array_hash(self.mask)
+
+    def analyse(self, options=None):
+        """Analyses the thresholded channels inside the mask
+
+        Results are cached per channel in analysis_cache.json, keyed by the
+        hash of the channel image, the threshold, the hash of the mask and
+        the version of lib.analysis.
+        Only stale channels are analysed, loading just their images, and
+        the results of all channels are merged into analysis.csv.
+
+        Parameters
+        ----------
+        options, optional
+            Channel indices, by default every thresholded channel
+
+        Returns
+        -------
+            Dict with the time (s) spent in every stage of the analysis and
+            list of the channels served from the cache
+        """
+
+        clr = Color()
+        if options == None:
+            options = range(len(self.channels))
+        options = [opt for opt in options if self.channels[opt].th != None]
+
+        path = f"samples/{self.name}/analysis_cache.json"
+        cache = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                cache = json.load(f)
+
+        store = self.image_store("image")
+        mask_hash = self.mask_hash()
+        keys = {
+            opt: [
+                store.digest(self.channels[opt].name),
+                float(self.channels[opt].th),
+                mask_hash,
+                ANALYSIS_VERSION,
+            ]
+            for opt in options
+        }
+        # Channels without stored image can't be analysed
+        options = [opt for opt in options if keys[opt][0] != None]
+        stale = [
+            opt
+            for opt in options
+            if cache.get(self.channels[opt].name, {}).get("key") != keys[opt]
+        ]
+        cached = [self.channels[opt].name for opt in options if opt not in stale]
+
+        timings = {}
+        if len(stale) > 0:
+            loaded = [
+                opt
+                for opt in stale
+                if not isinstance(getattr(self.channels[opt], "image"), np.ndarray)
+            ]
+            if len(loaded) > 0:
+                self.load_channels_images(im_type="image", options=loaded)
+            channels = [self.channels[opt] for opt in stale]
+            result, timings = analyse_channels(
+                images=[c.image for c in channels],
+                names=[c.name for c in channels],
+                thresholds=[c.th for c in channels],
+                mask=self.roi,
+            )
+            for opt, row in zip(stale, result):
+                # numpy types are kept, so analysis.csv is written the same way
+                cache[self.channels[opt].name] = {
+                    "key": keys[opt],
+                    "row": {k: getattr(v, "item", lambda: v)() for k, v in row.items()},
+                    "types": {
+                        k: v.dtype.str for k, v in row.items() if hasattr(v, "dtype")
+                    },
+                }
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(cache, f, indent=4)
+            os.replace(f"{path}.tmp", path)
+
+        for stage, t in timings.items():
+            print(f"{clr.GREY}{stage}: {t:.3f} s{clr.ENDC}")
+        if len(cached) > 0:
+            print(f"{clr.GREY}Cached: {', '.join(cached)}{clr.ENDC}")
+        rows = []
+        for opt in options:
+            entry = cache[self.channels[opt].name]
+            types = entry.get("types", {})
+            rows.append(
+                {
+                    k: np.dtype(types[k]).type(v) if k in types else v
+                    for k, v in entry["row"].items()
+                }
+            )
+        result_df = pd.DataFrame(rows)
         result_df.to_csv(f"samples/{self.name}/analysis.csv", index=False)
+        return timings, cached
+
+    def analyse_fibers(self):
+        """Quantifies every channel inside every fiber of the fiber labels
+
+        Channel images and fiber labels have to be loaded. The fibers x
+        channels feature table is stored in fiber_analysis.csv
+        """
+
+        channels = [
+            c for c in self.channels if isinstance(getattr(c, "image"), np.ndarray)
+        ]
+        result = analyse_fibers(
+            labels=self.fiber_labels,
+            images=[c.image for c in channels],
+            names=[c.name for c in channels],
+            thresholds=[c.th for c in channels],
+            mask=self.roi,
+        )
+        result_df = pd.DataFrame(result)
+        result_df.to_csv(f"samples/{self.name}/fiber_analysis.csv", index=False)
+        return result_df
+
+    def colocalization(self, options=None):
+        """Pairwise colocalization of the thresholded channels inside the mask
+
+        Channel images have to be loaded (memory mapped images are streamed,
+        see lib.analysis.colocalization). The (channels x channels) Pearson
+        and Manders matrices are stored in colocalization_pearson.csv and
+        colocalization_manders.csv, where row i column j of the Manders
+        matrix is the fraction of the positive intensity of channel i on
+        positive pixels of channel j.
+
+        Parameters
+        ----------
+        options, optional
+            Channel indices, by default every thresholded channel with image
+
+        Returns
+        -------
+            (Pearson DataFrame, Manders DataFrame)
+        """
+
+        if options == None:
+            options = range(len(self.channels))
+        channels = [
+            self.channels[opt]
+            for opt in options
+            if isinstance(getattr(self.channels[opt], "image"), np.ndarray)
+            and self.channels[opt].th != None
+        ]
+        result = colocalization(
+            images=[c.image for c in channels],
+            thresholds=[c.th for c in channels],
+            mask=self.roi,
+        )
+        names = [c.name for c in channels]
+        res = []
+        for key in ["Pearson", "Manders"]:
+            df = pd.DataFrame(result[key], index=names, columns=names)
+            df.index.name = "Channel"
+            df.to_csv(f"samples/{self.name}/colocalization_{key.lower()}.csv")
+            res.append(df)
+        return tuple(res)
+
+    def fiber_points_path(self):
+        return f"samples/{self.name}/fiber_points.npz"
+
+    def assign_fiber_points(self, options=None):
+        """Assigns every point of the segmented channels to its fiber
+
+        The assignment (a fiber label per point, see lib.analysis.assign_points)
+        is stored in fiber_points.npz and reused
+        until the points, the fiber labels or the mask change. Fiber labels
+        are only loaded if some channel has to be assigned again.
+
+        Parameters
+        ----------
+        options, optional
+            Channel indices, by default every channel with points
+
+        Returns
+        -------
+            (fibers, area, assignments): labels and areas of the fibers and a
+            dict with the fiber label of every point of every channel. None
+            if the sample has no fiber labels
+        """
+
+        if options == None:
+            options = [i for i, c in enumerate(self.channels) if c.count_points()]
+        path = f"samples/{self.name}"
+        labels_key = source_key(f"{path}/fiber_labels.npz")
+        if labels_key == None and getattr(self, "fiber_labels", None) is None:
+            return None
+        mask_key = source_key(f"{path}/mask.npy")
+        # Unsaved labels or mask can't be identified, nothing is reused
+        reusable = labels_key != None and "mask" not in self.__dict__.get(
+            "_dirty", set()
+        )
+        keys = {"labels": labels_key, "mask": () if mask_key == None else mask_key}
+
+        cache = {}
+        if reusable and os.path.isfile(self.fiber_points_path()):
+            with np.load(self.fiber_points_path()) as data:
+                cache = {k: data[k] for k in data.files}
+            if any(tuple(cache.get(k, [None])) != tuple(v) for k, v in keys.items()):
+                cache = {}
+
+        sources = {}
+        for opt in options:
+            c = self.channels[opt]
+            # Points not saved yet are assigned but not stored
+            stored = "points" not in getattr(c, "dirty", set())
+            sources[opt] = source_key(self.points_path(opt)) if stored else None
+        stale = [
+            opt
+            for opt in options
+            if sources[opt] == None
+            or tuple(cache.get(f"{self.channels[opt].name}.key", ())) != sources[opt]
+        ]
+
+        if len(stale) > 0 or len(cache) == 0:
+            if getattr(self, "fiber_labels", None) is None:
+                self.load_fiber_labels()
+            labels = self.fiber_labels
+            if len(cache) == 0:
+                cache = {k: np.array(v, dtype=np.int64) for k, v in keys.items()}
+                cache["fibers"], cache["area"] = fiber_areas(labels, self.roi)
+            clr = Color()
+            for opt in tqdm(
+                stale, desc=f"{clr.GREY}Assigning points to fibers", postfix=clr.ENDC
+            ):
+                c = self.channels[opt]
+                self.load_points(opt)
+                cache[f"{c.name}.fiber"] = assign_points(labels, c.points, self.roi)
+                if sources[opt] != None:
+                    cache[f"{c.name}.key"] = np.array(sources[opt], dtype=np.int64)
+                else:
+                    cache.pop(f"{c.name}.key", None)
+            if reusable:
+                with open(f"{self.fiber_points_path()}.tmp", "wb") as f:
+                    np.savez(f, **cache)
+                os.replace(f"{self.fiber_points_path()}.tmp", self.fiber_points_path())
+
+        assignments = {
+            opt: cache[f"{self.channels[opt].name}.fiber"] for opt in options
+        }
+        return cache["fibers"], cache["area"], assignments
+
+    def count_fiber_points(self, options=None):
+        """Counts the points of every channel inside every fiber and the ROI
+
+        The per-fiber point counts and densities (points per pixel) are
+        stored in fiber_points.csv and the per-channel counts inside the
+        mask and inside fibers in roi_points.csv, see assign_fiber_points
+
+        Returns
+        -------
+            (fiber DataFrame, ROI DataFrame), None if the sample has no fiber
+            labels
+        """
+
+        assigned = self.assign_fiber_points(options)
+        if assigned == None:
+            return None
+        fibers, area, assignments = assigned
+        names = [self.channels[opt].name for opt in assignments]
+        result = fiber_point_counts(fibers, area, assignments.values(), names)
+        fiber_df = pd.DataFrame(result)
+        fiber_df.to_csv(f"samples/{self.name}/fiber_points.csv", index=False)
+
+        roi_area = self.roi.area if self.roi != None else int(np.prod(self.img_size))
+        fiber_area = int(np.sum(area))
+        rows = []
+        for opt, fiber_of_points in assignments.items():
+            in_roi = int(np.count_nonzero(fiber_of_points >= 0))
+            in_fibers = int(np.count_nonzero(fiber_of_points > 0))
+            rows.append(
+                {
+                    "Channel": self.channels[opt].name,
+                    "Points": len(fiber_of_points),
+                    "ROI Points": in_roi,
+                    "ROI Area": roi_area,
+                    "ROI Point Density": in_roi / roi_area if roi_area else 0,
+                    "Fiber Points": in_fibers,
+                    "Fiber Area": fiber_area,
+                    "Fiber Point Density": in_fibers / fiber_area if fiber_area else 0,
+                }
+            )
+        roi_df = pd.DataFrame(rows)
+        roi_df.to_csv(f"samples/{self.name}/roi_points.csv", index=False)
+        return fiber_df, roi_df
 
     def segment_fibers(self):
         for c in self.channels:
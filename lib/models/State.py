@@ -2,16 +2,15 @@
 Author: José Verdú-Díaz
 """
 import os
-import gc
+import numpy as np
 import pandas as pd
-import tkinter as tk
 import tabulate as tblt
-from tkinter import filedialog
 
 import lib.utils as utils
+import lib.viewer as viewer
 from lib.models.Colors import Color
 from lib.models.Sample import Sample
-from lib.image import segment_points
+from lib.models.ChannelStore import benchmark_codecs
 
 
 class State:
@@ -49,6 +48,9 @@ class State:
         self.current_sample = self.current_sample.dump_fiber_labels()
 
     def import_labels(self):
+        import tkinter as tk
+        from tkinter import filedialog
+
         clr = Color()
         root = tk.Tk()
         root.withdraw()
@@ -76,6 +78,9 @@ class State:
     ####################################################################
 
     def create_new(self, name):
+        import tkinter as tk
+        from tkinter import filedialog
+
         clr = Color()
 
         if name in self.samples["Sample"].to_list():
@@ -129,48 +134,58 @@ class State:
 
     def point_segm(self, opt: int):
         clr = Color()
-        if not os.path.isfile(f"samples/{self.current_sample.name}/image.npz"):
+        if not self.current_sample.has_images(im_type="image"):
             input(
-                f"{clr.RED}The file image.npz does not exist. Press Enter to continue...{clr.ENDC}"
+                f"{clr.RED}Channel images do not exist. Press Enter to continue...{clr.ENDC}"
             )
             return
 
-        self.current_sample.load_channels_images(im_type="image", options=opt)
-        with utils.suppress_output(
-            suppress_stdout=not self.debug, suppress_stderr=not self.debug
-        ):
-            img = self.current_sample.napari_display(
-                options=[opt], point_segm=True, mask=True
-            )
-
-        points = segment_points(img)
-        x = [p[0] for p in points]
-        y = [p[1] for p in points]
-        a = [p[2] for p in points]
-        self.current_sample.channels[opt].points = pd.DataFrame(
-            list(zip(range(len(x)), x, y, a)),
-            columns=["index", "axis-0", "axis-1", "area"],
+        res = viewer.display(
+            self.current_sample, [opt], debug=self.debug, point_segm=True, mask=True
         )
-
-        with utils.suppress_output(
-            suppress_stdout=not self.debug, suppress_stderr=not self.debug
-        ):
-            res = self.current_sample.napari_display(
-                options=[opt], mask=True, point_filter=True
+        if res == None:
+            input(f"{clr.RED}Press Enter to continue...{clr.ENDC}")
+            return
+        c = self.current_sample.channels[opt]
+        c.point_params = res["point_params"]
+        # Restored if the area filter is not accepted, so the candidate points
+        # are not saved
+        previous = {
+            k: c.__dict__.get(k) for k in ["points", "n_points", "point_params"]
+        }
+        previous["dirty"] = set(getattr(c, "dirty", set()))
+
+        # Segment with the parameters chosen in napari, the area filter is
+        # chosen in the next step
+        with self.current_sample.transaction():
+            self.current_sample.segment_points(
+                opt, params={"min_area_percentile": 0, "max_area_percentile": 100}
             )
 
-        x = [p[0] for p in res.data]
-        y = [p[1] for p in res.data]
-        a = list(res.features["area"])
-
-        self.current_sample.channels[opt].points = pd.DataFrame(
-            list(zip(range(len(x)), x, y, a)),
-            columns=["index", "axis-0", "axis-1", "area"],
-        )
+            res = viewer.display(
+                self.current_sample,
+                [opt],
+                debug=self.debug,
+                mask=True,
+                point_filter=True,
+            )
+            if res == None:
+                c.__dict__.update(previous)
+                c.__dict__.pop("point_index", None)
+                input(f"{clr.RED}Press Enter to continue...{clr.ENDC}")
+                return
+            c.point_params = res["point_params"]
+
+            data, a = res["points"]
+            x = [p[0] for p in data]
+            y = [p[1] for p in data]
+            c.points = pd.DataFrame(
+                list(zip(range(len(x)), x, y, a)),
+                columns=["index", "axis-0", "axis-1", "area"],
+            )
 
-        self.current_sample.update_df()
-        self.current_sample.save_points(opt)
-        self.current_sample.save()
+            self.current_sample.update_df()
+            self.current_sample.save_points(opt)
         self.dump()
 
         input(
@@ -179,28 +194,27 @@ class State:
 
     def threshold(self, opt: int):
         clr = Color()
-        if not os.path.isfile(f"samples/{self.current_sample.name}/image.npz"):
+        if not self.current_sample.has_images(im_type="image"):
             input(
-                f"{clr.RED}The file image.npz does not exist. Press Enter to continue...{clr.ENDC}"
+                f"{clr.RED}Channel images do not exist. Press Enter to continue...{clr.ENDC}"
             )
             return
 
-        self.current_sample.load_channels_images(im_type="image", options=opt)
         if utils.input_yes_no(txt="Use napari for selecting a percentile?"):
-            with utils.suppress_output(
-                suppress_stdout=not self.debug, suppress_stderr=not self.debug
-            ):
-                self.current_sample = self.current_sample.napari_display(
-                    options=[opt], mask=True, threshold=True
-                )
-        else:
-            max = (
-                self.current_sample.channels[opt]
-                .apply_mask(self.current_sample.mask)
-                .max()
+            res = viewer.display(
+                self.current_sample, [opt], debug=self.debug, mask=True, threshold=True
             )
+            if res == None:
+                input(f"{clr.RED}Press Enter to continue...{clr.ENDC}")
+                return
+            self.current_sample.channels[opt].th = res["th"]
+        else:
+            _, max = self.current_sample.channel_range(opt, region="mask")
+            # Looked up in the stored histogram, no pixels are loaded
+            p99 = self.current_sample.channel_percentile(opt, 99, region="mask")
+            p99 = "" if p99 == None else f", 99th percentile: {p99:.4g}"
             th = utils.input_number(
-                f"Enter a threshold (between 0 and {max})",
+                f"Enter a threshold (between 0 and {max}{p99})",
                 cancel=False,
                 range=(0, max),
                 type="float",
@@ -225,10 +239,9 @@ class State:
             if options[opt] and opt not in ["m", "l"]:
                 channels.append(opt)
         if len(channels) > 0:
-            res = self.current_sample.load_channels_images(options=channels)
-            if res == None:
+            if not self.current_sample.has_images(im_type="image"):
                 input(
-                    f"{clr.RED}File {opt}.npz does not exist. Press Enter to continue...{clr.ENDC}"
+                    f"{clr.RED}Channel images do not exist. Press Enter to continue...{clr.ENDC}"
                 )
                 self.dump()
                 return
@@ -236,23 +249,25 @@ class State:
             channels.append("m")
         if options["l"]:
             channels.append("l")
-            res = self.current_sample.load_fiber_labels()
-            if res == None:
+            if not os.path.isfile(
+                f"samples/{self.current_sample.name}/fiber_labels.npz"
+            ):
                 input(
                     f"{clr.RED}File fiber_labels.npz does not exist, segment fibers first. Press Enter to continue...{clr.ENDC}"
                 )
                 self.dump()
                 return
 
-        with utils.suppress_output(
-            suppress_stdout=not self.debug, suppress_stderr=not self.debug
-        ):
-            self.current_sample.napari_display(
-                options=channels, screenshot=True, toggle_mask=True
-            )
-
-        self.dump()
-        gc.collect()
+        # The viewer runs in its own process, see lib.viewer
+        res = viewer.display(
+            self.current_sample,
+            channels,
+            debug=self.debug,
+            screenshot=True,
+            toggle_mask=True,
+        )
+        if res == None:
+            input(f"{clr.RED}Press Enter to continue...{clr.ENDC}")
 
     ####################################################################
     ############################ ANALYSIS ##############################
@@ -261,28 +276,120 @@ class State:
     def analyse(self):
         clr = Color()
         print(f"\n{clr.CYAN}Analyzing, this might take some seconds...{clr.ENDC}")
-        res = self.current_sample.load_channels_images(im_type="image")
-        if res == None:
+        if not self.current_sample.has_images(im_type="image"):
             input(
-                f"{clr.RED}File image.npz does not exist. Press Enter to continue...{clr.ENDC}"
+                f"{clr.RED}Channel images do not exist. Press Enter to continue...{clr.ENDC}"
             )
             return
-        self.current_sample.analyse()
+        # Only the images of channels not in the analysis cache are loaded
+        _, cached = self.current_sample.analyse()
         self.dump()
         print(
-            f"\n{clr.GREEN}Images analyzed successfully! Press Enter to continue...{clr.ENDC}"
+            f"\n{clr.GREEN}Images analyzed successfully! {len(cached)} channels served from the cache.{clr.ENDC}"
         )
         input(
             f"{clr.GREEN}Output at samples/{self.current_sample.name}/analysis.csv Press Enter to continue...{clr.ENDC}"
         )
 
+    def colocalization(self):
+        clr = Color()
+        print(
+            f"\n{clr.CYAN}Computing colocalization, this might take some seconds...{clr.ENDC}"
+        )
+        thresholded = [
+            i for i, c in enumerate(self.current_sample.channels) if c.th != None
+        ]
+        if len(thresholded) < 2:
+            input(
+                f"{clr.RED}At least two channels have to be thresholded. Press Enter to continue...{clr.ENDC}"
+            )
+            return
+        res = self.current_sample.load_channels_images(
+            im_type="image", options=thresholded
+        )
+        if res == None:
+            input(
+                f"{clr.RED}Channel images do not exist. Press Enter to continue...{clr.ENDC}"
+            )
+            return
+        pearson, _ = self.current_sample.colocalization(thresholded)
+        self.dump()
+        input(
+            f"{tblt.tabulate(pearson.round(3), headers='keys', tablefmt='github')}\n\n{clr.GREEN}Output at samples/{self.current_sample.name}/colocalization_pearson.csv and colocalization_manders.csv Press Enter to continue...{clr.ENDC}"
+        )
+
+    def benchmark_codecs(self, im_type="image"):
+        clr = Color()
+        print(
+            f"\n{clr.CYAN}Benchmarking codecs, this might take some time...{clr.ENDC}"
+        )
+        res = self.current_sample.load_channels_images(im_type=im_type)
+        if res == None:
+            input(
+                f"{clr.RED}Images {im_type} do not exist. Press Enter to continue...{clr.ENDC}"
+            )
+            return
+        images = {
+            c.name: np.asarray(getattr(c, im_type))
+            for c in self.current_sample.channels
+            if isinstance(getattr(c, im_type, None), np.ndarray)
+        }
+        result = pd.DataFrame(benchmark_codecs(images))
+        self.dump()
+        input(
+            f"\n{tblt.tabulate(result, headers='keys', tablefmt='github', showindex=False)}\n\nPress Enter to continue..."
+        )
+
+    def analyse_fibers(self):
+        clr = Color()
+        print(
+            f"\n{clr.CYAN}Analyzing fibers, this might take some seconds...{clr.ENDC}"
+        )
+        res = self.current_sample.load_fiber_labels()
+        if res == None:
+            input(
+                f"{clr.RED}File fiber_labels.npz does not exist, import fiber labels first. Press Enter to continue...{clr.ENDC}"
+            )
+            return
+        res = self.current_sample.load_channels_images(im_type="image")
+        if res == None:
+            input(
+                f"{clr.RED}Channel images do not exist. Press Enter to continue...{clr.ENDC}"
+            )
+            self.dump()
+            return
+        self.current_sample.analyse_fibers()
+        self.dump()
+        input(
+            f"{clr.GREEN}Output at samples/{self.current_sample.name}/fiber_analysis.csv Press Enter to continue...{clr.ENDC}"
+        )
+
+    def count_fiber_points(self):
+        clr = Color()
+        print(f"\n{clr.CYAN}Counting points per fiber...{clr.ENDC}")
+        if not any(c.count_points() for c in self.current_sample.channels):
+            input(
+                f"{clr.RED}No channel has points, segment dot-like elements first. Press Enter to continue...{clr.ENDC}"
+            )
+            return
+        res = self.current_sample.count_fiber_points()
+        self.dump()
+        if res == None:
+            input(
+                f"{clr.RED}File fiber_labels.npz does not exist, import fiber labels first. Press Enter to continue...{clr.ENDC}"
+            )
+            return
+        input(
+            f"{tblt.tabulate(res[1], headers='keys', tablefmt='github', showindex=False)}\n\n{clr.GREEN}Output at samples/{self.current_sample.name}/fiber_points.csv Press Enter to continue...{clr.ENDC}"
+        )
+
     def segment_fibers(self):
         clr = Color()
         print(f"\n{clr.CYAN}Segmenting, this might take some seconds...{clr.ENDC}")
         res = self.current_sample.load_channels_images(im_type="image_thre")
         if res == None:
             input(
-                f"{clr.RED}File image_thre.npz does not exist, threshold channel Tm(169) first. Press Enter to continue...{clr.ENDC}"
+                f"{clr.RED}Images image_thre do not exist, threshold channel Tm(169) first. Press Enter to continue...{clr.ENDC}"
             )
             return
         with utils.suppress_output(
@@ -0,0 +1,84 @@
+"""Multiscale image pyramids
+
+This module contains the functions used to build the downsampled levels
+shown by napari when an image doesn't fit the screen. Every level halves
+the previous one, and is computed in blocks of rows so memory mapped images
+are streamed instead of read at once.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+n_levels
+    Amount of downsampled levels of an image
+downsample
+    Halves an image
+build_pyramid
+    Downsampled levels of an image
+"""
+import numpy as np
+
+# Levels are added until the image fits in a square of this size
+MIN_SIZE = 1024
+# Rows of the input image read at once by downsample
+BLOCK_ROWS = 2048
+
+
+def n_levels(shape, min_size=MIN_SIZE):
+    """Amount of downsampled levels needed for an image to fit in min_size"""
+
+    n, size = 0, max(shape)
+    while size > min_size:
+        size = (size + 1) // 2
+        n += 1
+    return n
+
+
+def downsample(img, method="mean"):
+    """Halves an image, reading it in blocks of rows
+
+    Parameters
+    ----------
+    img
+        2D image (array or memmap)
+    method, optional
+        'mean' averages every 2x2 block (intensity images), 'nearest' keeps
+        its top left pixel (masks and labels). By default 'mean'
+
+    Returns
+    -------
+        Image of shape ceil(shape / 2), same dtype as img
+    """
+
+    rows, cols = img.shape
+    out = np.empty(((rows + 1) // 2, (cols + 1) // 2), dtype=img.dtype)
+    step = max(2, BLOCK_ROWS // 2 * 2)
+    for start in range(0, rows, step):
+        block = np.asarray(img[start : start + step])
+        if method == "nearest":
+            out[start // 2 : (start + len(block) + 1) // 2] = block[::2, ::2]
+            continue
+        # Odd borders are padded by repeating the last row or column
+        pad = ((0, len(block) % 2), (0, cols % 2))
+        block = np.pad(block, pad, mode="edge").astype(np.float32)
+        mean = block.reshape(len(block) // 2, 2, -1, 2).mean(axis=(1, 3))
+        if np.issubdtype(img.dtype, np.integer):
+            mean = np.rint(mean)
+        out[start // 2 : start // 2 + len(mean)] = mean
+    return out
+
+
+def build_pyramid(img, method="mean", min_size=MIN_SIZE):
+    """Downsampled levels of an image, see downsample
+
+    Returns
+    -------
+        List of levels, from half the size of img to the first level that
+        fits in min_size. Empty if img already fits
+    """
+
+    levels = []
+    for _ in range(n_levels(img.shape, min_size)):
+        img = downsample(img, method)
+        levels.append(img)
+    return levels
@@ -0,0 +1,134 @@
+"""ROI rasterization
+
+This module contains the functions used to convert the annotations of a
+geojson file into a boolean mask. Every polygon is filled with OpenCV in a
+buffer the size of its own bounding box, which is then merged into the
+mask, so the cost depends on the area of the polygons and not on the
+amount of polygons times the image size. Holes (interior rings) and multi
+geometries are supported.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+geojson_polygons
+    Polygons (lists of rings) of the features of a geojson object
+rasterize_polygons
+    Boolean mask of a list of polygons
+rasterize_geojson
+    Boolean mask of the annotations of a geojson file
+geojson_key
+    Hash of a geojson file and an image size
+"""
+import json
+import numpy as np
+
+from lib.cache import file_hash
+
+# Bits of subpixel precision of the polygon vertices
+SHIFT = 4
+
+
+def geojson_polygons(data):
+    """Polygons of a geojson object
+
+    Parameters
+    ----------
+    data
+        FeatureCollection, Feature or geometry (parsed json)
+
+    Returns
+    -------
+        List of polygons, each one a list of rings (arrays (n x 2) of x, y
+        coordinates), the first ring being the outer boundary and the rest
+        holes. LineStrings are closed and treated as polygons without holes
+    """
+
+    if data == None:
+        return []
+    kind = data.get("type")
+    if kind == "FeatureCollection":
+        return [p for f in data["features"] for p in geojson_polygons(f)]
+    if kind == "Feature":
+        return geojson_polygons(data.get("geometry"))
+    if kind == "GeometryCollection":
+        return [p for g in data["geometries"] for p in geojson_polygons(g)]
+
+    coords = data.get("coordinates", [])
+    if kind == "Polygon":
+        polygons = [coords]
+    elif kind == "MultiPolygon":
+        polygons = coords
+    elif kind == "LineString":
+        polygons = [[coords]]
+    elif kind == "MultiLineString":
+        polygons = [[line] for line in coords]
+    else:
+        return []
+    return [
+        [np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon]
+        for polygon in polygons
+        if len(polygon) > 0 and len(polygon[0]) > 0
+    ]
+
+
+def rasterize_polygons(polygons, shape):
+    """Boolean mask of a list of polygons
+
+    Every polygon is rasterized in a buffer the size of its bounding box:
+    the outer ring is filled, holes are cleared and their boundary is drawn
+    back, as it belongs to the polygon. Pixels on the boundary of a polygon
+    are inside the mask.
+
+    Parameters
+    ----------
+    polygons
+        List of polygons, see geojson_polygons
+    shape
+        Shape (rows, columns) of the mask
+
+    Returns
+    -------
+        Boolean mask
+    """
+
+    import cv2
+
+    mask = np.zeros(shape, dtype=bool)
+    scale = 1 << SHIFT
+    for rings in polygons:
+        outer = rings[0]
+        lo = np.maximum(np.floor(outer.min(axis=0)).astype(np.int64), 0)
+        hi = np.minimum(
+            np.ceil(outer.max(axis=0)).astype(np.int64) + 1, (shape[1], shape[0])
+        )
+        if np.any(hi <= lo):
+            continue
+
+        # Vertices relative to the bounding box, with subpixel precision
+        local = [np.round((r - lo) * scale).astype(np.int32) for r in rings]
+        buffer = np.zeros((hi[1] - lo[1], hi[0] - lo[0]), dtype=np.uint8)
+        cv2.fillPoly(buffer, local[:1], 1, shift=SHIFT)
+        if len(local) > 1:
+            cv2.fillPoly(buffer, local[1:], 0, shift=SHIFT)
+            cv2.polylines(buffer, local[1:], True, 1, shift=SHIFT)
+        mask[lo[1] : hi[1], lo[0] : hi[0]] |= buffer.astype(bool)
+    return mask
+
+
+def rasterize_geojson(path, shape):
+    """Boolean mask of the annotations of a geojson file, see rasterize_polygons"""
+
+    with open(path) as f:
+        data = json.load(f)
+    return rasterize_polygons(geojson_polygons(data), shape)
+
+
+def geojson_key(path, shape):
+    """Hash of the content of a geojson file and the image size
+
+    Identifies the mask rasterized from the file, so it is only rebuilt when
+    the annotations (or the image size) change
+    """
+
+    return file_hash(path, extra=str(tuple(int(x) for x in shape)))
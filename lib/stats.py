@@ -0,0 +1,120 @@
+"""Channel statistics
+
+This module contains the functions used to compute the per-channel
+statistics and cumulative histograms that are stored at ingest time, so
+thresholds and display ranges can be obtained without loading pixel data.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+region_stats
+    Statistics and cumulative histogram of a set of pixels
+channel_stats
+    Statistics of a channel over the whole image and inside the mask
+histogram_percentile
+    Approximates a percentile from a cumulative histogram
+"""
+import numpy as np
+
+from lib.models.Roi import Roi
+
+PERCENTILES = [1, 5, 10, 25, 50, 75, 90, 95, 97, 98, 99, 99.5, 99.9]
+HIST_BINS = 4096
+REGIONS = ["image", "mask"]
+
+
+def region_stats(pixels, bins=HIST_BINS):
+    """Statistics and cumulative histogram of a set of pixels
+
+    Parameters
+    ----------
+    pixels
+        Array of pixel values
+    bins, optional
+        Amount of histogram bins between the min and max values, by default
+        HIST_BINS
+
+    Returns
+    -------
+        Dictionary of statistics (min, max, mean, count, nonzero and
+        percentiles) and a tuple (edges, cdf) with the bin edges and the
+        cumulative pixel count at the right edge of every bin
+    """
+
+    pixels = np.ravel(pixels)
+    if pixels.size == 0:
+        stats = {
+            "min": None,
+            "max": None,
+            "mean": None,
+            "count": 0,
+            "nonzero": 0,
+            "percentiles": {},
+        }
+        return stats, (np.zeros(bins + 1), np.zeros(bins, dtype="int64"))
+
+    p_values = np.percentile(pixels, PERCENTILES)
+    stats = {
+        "min": float(pixels.min()),
+        "max": float(pixels.max()),
+        "mean": float(np.mean(pixels)),
+        "count": int(pixels.size),
+        "nonzero": int(np.count_nonzero(pixels)),
+        "percentiles": {str(p): float(v) for p, v in zip(PERCENTILES, p_values)},
+    }
+
+    counts, edges = np.histogram(pixels, bins=bins, range=(stats["min"], stats["max"]))
+    return stats, (edges, np.cumsum(counts))
+
+
+def channel_stats(img, mask=None, bins=HIST_BINS):
+    """Statistics of a channel over the whole image and inside the mask
+
+    The mask can be a boolean array or a Roi.
+
+    Returns
+    -------
+        Tuple (stats, histograms) of dictionaries keyed by region
+        ('image', 'mask'), see region_stats
+    """
+
+    stats, histograms = {}, {}
+    stats["image"], histograms["image"] = region_stats(img, bins)
+    if isinstance(mask, Roi):
+        stats["mask"], histograms["mask"] = region_stats(mask.pixels(img), bins)
+    elif isinstance(mask, np.ndarray):
+        stats["mask"], histograms["mask"] = region_stats(np.asarray(img)[mask], bins)
+    return stats, histograms
+
+
+def histogram_percentile(edges, cdf, p):
+    """Approximates a percentile from a cumulative histogram
+
+    The percentile is found with a binary search on the cumulative counts
+    and linearly interpolated inside its bin.
+
+    Parameters
+    ----------
+    edges
+        Bin edges, of length len(cdf) + 1
+    cdf
+        Cumulative pixel count at the right edge of every bin
+    p
+        Percentile, between 0 and 100
+
+    Returns
+    -------
+        Approximate value of the percentile
+    """
+
+    total = cdf[-1]
+    if total == 0:
+        return None
+    rank = p / 100 * total
+    i = int(np.searchsorted(cdf, rank, side="left"))
+    i = min(i, len(cdf) - 1)
+    prev = cdf[i - 1] if i > 0 else 0
+    in_bin = cdf[i] - prev
+    frac = 0.0 if in_bin == 0 else (rank - prev) / in_bin
+    return float(edges[i] + frac * (edges[i + 1] - edges[i]))
@@ -0,0 +1,217 @@
+"""Tiled image processing
+
+This module contains the functions used to split a region of an image into
+tiles, process them in parallel with a halo of neighbouring pixels, and
+merge the objects that cross the seams between tiles. Only a few tiles are
+processed at the same time, so the memory footprint depends on the tile
+size and not on the image size.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+grow
+    Grows a region by a margin, clipped to the image
+tile_slices
+    Splits a region into tiles
+map_tiles
+    Applies a function to every tile in parallel
+tile_seams
+    Pairs of neighbouring tiles
+tile_edges
+    Labels along the edges of a tile
+edge_pairs
+    Pairs of labels of neighbouring tiles that touch across a seam
+merge_labels
+    Merges labels connected across seams
+"""
+import numpy as np
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+
+TILE_SIZE = 2048
+
+
+def grow(region, margin, shape):
+    """Grows a region (tuple of slices) by a margin, clipped to the image shape"""
+
+    return tuple(
+        slice(max(sl.start - margin, 0), min(sl.stop + margin, dim))
+        for sl, dim in zip(region, shape)
+    )
+
+
+def local(region, outer):
+    """Returns a region relative to the origin of an outer region"""
+
+    return tuple(
+        slice(sl.start - o.start, sl.stop - o.start) for sl, o in zip(region, outer)
+    )
+
+
+def tile_slices(region, size=TILE_SIZE):
+    """Splits a region into tiles
+
+    Parameters
+    ----------
+    region
+        Tuple of slices (rows, columns)
+    size, optional
+        Maximum size of the tiles in both axes, by default TILE_SIZE
+
+    Returns
+    -------
+        2D list (rows x columns) of tiles, each one a tuple of slices
+    """
+
+    starts = [range(sl.start, sl.stop, size) for sl in region]
+    return [
+        [
+            (
+                slice(r, min(r + size, region[0].stop)),
+                slice(c, min(c + size, region[1].stop)),
+            )
+            for c in starts[1]
+        ]
+        for r in starts[0]
+    ]
+
+
+def map_tiles(func, tiles, workers=None):
+    """Applies a function to every tile in a thread pool
+
+    Parameters
+    ----------
+    func
+        Function of a tile (tuple of slices)
+    tiles
+        2D list of tiles (see tile_slices)
+    workers, optional
+        Amount of threads, by default the ThreadPoolExecutor default
+
+    Returns
+    -------
+        2D list with the result of every tile
+    """
+
+    flat = [t for row in tiles for t in row]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(func, flat))
+    n_cols = len(tiles[0]) if len(tiles) > 0 else 0
+    return [results[i : i + n_cols] for i in range(0, len(results), n_cols)]
+
+
+####################################################################
+########################## SEAM MERGING ############################
+####################################################################
+
+
+def seam_pairs(a, b):
+    """Pairs of 8-connected labels across a seam
+
+    Parameters
+    ----------
+    a, b
+        Labels along the touching edges (1D arrays of the same length) of two
+        neighbouring tiles
+
+    Returns
+    -------
+        Array (n x 2) of label pairs, 0 (background) excluded
+    """
+
+    pairs = []
+    for x, y in ((a, b), (a[1:], b[:-1]), (a[:-1], b[1:])):
+        touching = (x != 0) & (y != 0)
+        pairs.append(np.stack([x[touching], y[touching]], axis=1))
+    return np.concatenate(pairs)
+
+
+def tile_edges(labels):
+    """Labels along the four edges of a tile, the only ones needed to merge it"""
+
+    return {
+        "top": labels[0, :].copy(),
+        "bottom": labels[-1, :].copy(),
+        "left": labels[:, 0].copy(),
+        "right": labels[:, -1].copy(),
+    }
+
+
+def edge_pairs(a, b, kind):
+    """Pairs of 8-connected labels of two neighbouring tiles
+
+    Parameters
+    ----------
+    a, b
+        Edges of the tiles (see tile_edges), a being the upper (or left) tile
+    kind
+        'v' (b below a), 'h' (b right of a), 'd' (b below and right of a) or
+        'a' (b below and left of a), see tile_seams
+
+    Returns
+    -------
+        Array (n x 2) of label pairs, 0 (background) excluded
+    """
+
+    if kind == "v":
+        return seam_pairs(a["bottom"], b["top"])
+    if kind == "h":
+        return seam_pairs(a["right"], b["left"])
+    if kind == "d":
+        x, y = a["bottom"][-1], b["top"][0]
+    else:
+        x, y = a["bottom"][0], b["top"][-1]
+    if x != 0 and y != 0:
+        return np.array([[x, y]])
+    return np.empty((0, 2), dtype=np.int64)
+
+
+def merge_labels(n, pairs):
+    """Merges labels connected across seams
+
+    Parameters
+    ----------
+    n
+        Total amount of labels, numbered from 0 to n - 1
+    pairs
+        Array (m x 2) of connected labels
+
+    Returns
+    -------
+        Array with the merged object of every label, numbered from 0
+    """
+
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n, n)
+    )
+    _, objects = connected_components(graph, directed=False)
+    return objects
+
+
+def tile_seams(tiles):
+    """Pairs of neighbouring tiles, including diagonal neighbours
+
+    Returns
+    -------
+        List of ((row, col), (row, col), kind), kind being 'v' (vertical
+        neighbours), 'h' (horizontal neighbours), 'd' (down-right diagonal)
+        or 'a' (down-left diagonal)
+    """
+
+    n_rows, n_cols = len(tiles), len(tiles[0]) if len(tiles) > 0 else 0
+    seams = []
+    for r, c in product(range(n_rows), range(n_cols)):
+        if r + 1 < n_rows:
+            seams.append(((r, c), (r + 1, c), "v"))
+        if c + 1 < n_cols:
+            seams.append(((r, c), (r, c + 1), "h"))
+        if r + 1 < n_rows and c + 1 < n_cols:
+            seams.append(((r, c), (r + 1, c + 1), "d"))
+        if r + 1 < n_rows and c > 0:
+            seams.append(((r, c), (r + 1, c - 1), "a"))
+    return seams
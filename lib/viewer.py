@@ -0,0 +1,128 @@
+"""Out-of-process napari viewer
+
+This module runs Sample.napari_display in a child process, so napari and
+Qt are never imported by the main process and the memory they leak is
+returned to the system when the viewer is closed. The child rebuilds the
+sample from its manifest and memory-maps the channel images from the
+channel store, so no image data goes through the pipe. Only the results
+of the viewer (threshold, point segmentation parameters, filtered points)
+are sent back.
+
+Author: José Verdú-Díaz
+
+Methods
+-------
+display
+    Shows images of a sample in a napari viewer running in a child process
+"""
+import multiprocessing as mp
+
+from lib.models.Colors import Color
+
+
+def _viewer(conn, manifest, points, mask, options, flags, debug):
+    """Runs napari_display inside the child process and sends the results"""
+
+    try:
+        import lib.utils as utils
+        from lib.models.Sample import Sample
+
+        sample = Sample.from_manifest(manifest)
+        if mask is not None:
+            sample.mask = mask
+        for opt, df in points.items():
+            sample.channels[opt].points = df
+
+        channels = [opt for opt in options if isinstance(opt, int)]
+        if len(channels) > 0:
+            sample.load_channels_images(im_type="image", options=channels)
+        if "l" in options:
+            sample.load_fiber_labels()
+
+        with utils.suppress_output(
+            suppress_stdout=not debug, suppress_stderr=not debug
+        ):
+            res = sample.napari_display(options=options, **flags)
+
+        result = {}
+        if len(channels) == 1:
+            c = sample.channels[channels[0]]
+            result["th"] = c.th
+            result["point_params"] = c.point_params
+        if flags.get("point_filter"):
+            result["points"] = (res.data, list(res.features["area"]))
+        conn.send(("ok", result))
+    except BaseException as e:
+        conn.send(("failed", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def display(sample, options, debug=False, **flags):
+    """Shows images of a sample in a napari viewer running in a child process
+
+    The child process receives the metadata of the sample (its manifest),
+    the points of the displayed channels and the mask if they were not
+    saved yet. Channel images, the mask and the fiber labels are read from
+    their files.
+
+    Parameters
+    ----------
+    sample
+        Sample object
+    options
+        Images to show, see Sample.napari_display
+    debug, optional
+        Show the output of napari, by default False
+    flags
+        Keyword arguments of Sample.napari_display (mask, threshold, ...)
+
+    Returns
+    -------
+        Dict with the threshold ('th') and point segmentation parameters
+        ('point_params') of the channel, if a single channel is shown, and
+        the filtered points ('points', positions and areas) if point_filter
+        is True. None if the viewer failed
+    """
+
+    clr = Color()
+    points = {}
+    for opt in options:
+        if isinstance(opt, int):
+            c = sample.channels[opt]
+            if "points" in getattr(c, "dirty", set()) and not c.points.empty:
+                points[opt] = c.points
+    mask = None
+    if "mask" in sample.__dict__.get("_dirty", set()):
+        mask = sample.mask
+
+    ctx = mp.get_context("spawn")
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(
+        target=_viewer,
+        args=(
+            send_conn,
+            sample.manifest(),
+            points,
+            mask,
+            options,
+            flags,
+            debug,
+        ),
+        name=f"hipo-viewer-{sample.name}",
+    )
+    process.start()
+    send_conn.close()
+    try:
+        status, result = recv_conn.recv()
+    except EOFError:
+        # The child exited without sending a result (killed or crashed)
+        process.join()
+        status, result = "failed", f"Viewer exited with code {process.exitcode}"
+    process.join()
+    recv_conn.close()
+
+    if status != "ok":
+        print(f"{clr.RED}Viewer failed: {result}{clr.ENDC}")
+        return None
+    return result
@@ -5,12 +5,22 @@ Author: José Verdú-Díaz
 This is the entry point of the application. The objective is
 to keep this module as simple as possible, using it as a menu
 system and delegating all other tasks to the the State object.
+
+Running it with a subcommand (see lib.cli) performs a single task
+without user interaction, e.g.:
+
+    python main.py ingest NAME --txt S.txt --geojson R.geojson --tiff I.tiff
+    python main.py threshold NAME --set "Tm(169)=5.5"
+    python main.py analyse NAME --fibers
+    python main.py colocalization NAME --channel "Tm(169)" "Gd(155)"
+    python main.py check-imports --budget 1000
 """
 
 import os
 import sys
 import argparse
 
+import lib.cli as cli
 import lib.utils as utils
 from lib.models.State import State
 from lib.models.Colors import Color
@@ -35,6 +45,7 @@ def main(args):
         100: "Show most common types",
         200: "Show Growth",
         300: "Show Chain",
+        400: "Benchmark compression codecs",
     }
 
     SAMPLE_OPTIONS = {
@@ -42,13 +53,16 @@ def main(args):
         "a": "Analyze ",
         1: "Change Threshold",
         2: "Analyze",
+        6: "Analyze Fibers",
+        7: "Count Points per Fiber",
+        8: "Colocalization",
         "b": "Segmentation",
         3: "Import Fiber Labels",
         4: "Segment Dot-Like Elements",
         "c": "Visualize ",
         5: "Show Images",
         #'d': 'Edit',
-        #    6: 'Change Name'
+        #    9: 'Change Name'
     }
 
     if state.debug:
@@ -113,6 +127,18 @@ def main(args):
                 elif opt == 2:
                     state.analyse()
 
+                # Perform Per-Fiber Analysis
+                elif opt == 6:
+                    state.analyse_fibers()
+
+                # Count Points per Fiber
+                elif opt == 7:
+                    state.count_fiber_points()
+
+                # Colocalization
+                elif opt == 8:
+                    state.colocalization()
+
                 # Import Fiber Labels
                 elif opt == 3:
                     state.import_labels()
@@ -157,15 +183,17 @@ def main(args):
                     if options == None:
                         continue
                     else:
+                        # napari runs in a child process, its memory is
+                        # released when the viewer is closed
                         state.show_napari(options)
 
-                        # Memory leak related with napari or Qt, restart hipo to clean memory
-                        sys.stdout.flush()
-                        os.execv(sys.executable, ["python"] + sys.argv)
+                # Benchmark compression codecs
+                elif opt == 400:
+                    state.benchmark_codecs()
 
                 # Change Name
                 # BROKEN NEEDS FIX
-                # elif opt == 6: state.change_name(utils.input_text('Enter new sample name'))
+                # elif opt == 9: state.change_name(utils.input_text('Enter new sample name'))
 
                 else:
                     pass
@@ -174,5 +202,8 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--debug", action="store_true", help="Toggle debug mode)")
+    cli.add_subcommands(parser)
     args = parser.parse_args()
+    if args.command != None:
+        sys.exit(cli.run(args))
     main(args)
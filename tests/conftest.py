@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import lib from the root of the repository, like main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,69 @@
+"""Vectorized channel analysis against Channel.analyse"""
+import numpy as np
+import pytest
+
+from lib.analysis import analyse_channels
+from lib.models.Channel import Channel
+from lib.models.Roi import Roi
+
+
+def channels(shape=(120, 150), seed=0):
+    """Channels of several dtypes, with their thresholds"""
+
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(2.0, 300.0, (5,) + shape)
+    return [
+        (values[0].astype(np.uint16), 700.5),
+        (values[1].astype(np.float32), 612.3),
+        (values[2].astype(np.int32), 800),
+        (values[3], 455.25),
+        (values[4].astype(np.uint8), 120.0),
+        # No positive pixels
+        (values[0].astype(np.float32), 1e9),
+    ]
+
+
+def mask(shape=(120, 150)):
+    m = np.zeros(shape, dtype=bool)
+    m[10:100, 20:140] = True
+    m[40:60, 50:90] = False
+    return m
+
+
+def assert_same_row(row, ref):
+    assert row.keys() == ref.keys()
+    for k in ref:
+        if isinstance(ref[k], (np.generic, float)) and np.isnan(ref[k]):
+            assert np.isnan(row[k])
+        else:
+            assert row[k] == ref[k], k
+        # analysis.csv is written from these values, their types must match
+        assert np.asarray(row[k]).dtype == np.asarray(ref[k]).dtype, k
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("roi", [False, True])
+def test_mixed_dtypes_match_channel_analyse(roi):
+    data, m = channels(), mask()
+    images, thresholds = [d[0] for d in data], [d[1] for d in data]
+    names = [f"C{i}" for i in range(len(data))]
+    result, timings = analyse_channels(images, names, thresholds, Roi(m) if roi else m)
+    assert set(timings) == {"Gather", "Threshold", "Reduce"}
+    for i, (img, th) in enumerate(data):
+        ref = Channel(name=names[i], th=th, image=img).analyse(m)
+        assert_same_row(result[i], ref)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_results_dont_depend_on_the_batch():
+    data, m = channels(), mask()
+    names = [f"C{i}" for i in range(len(data))]
+    batch, _ = analyse_channels([d[0] for d in data], names, [d[1] for d in data], m)
+    for i, (img, th) in enumerate(data):
+        alone, _ = analyse_channels([img], [names[i]], [th], m)
+        assert_same_row(batch[i], alone[0])
+
+
+def test_empty_input():
+    result, _ = analyse_channels([], [], [], mask())
+    assert result == []
@@ -0,0 +1,29 @@
+"""Startup import time of HIPO, see lib.importtime"""
+import os
+import pytest
+
+from lib.importtime import check_imports
+
+
+@pytest.mark.parametrize("statement", ["import main", "import lib.cli"])
+def test_no_heavy_modules_at_startup(statement):
+    result = check_imports(statement)
+    assert result["heavy"] == []
+
+
+# Wall-clock times depend on the machine, the budget (ms) is only checked when
+# given, e.g. HIPO_IMPORT_BUDGET=1000 python -m pytest tests
+@pytest.mark.skipif(
+    "HIPO_IMPORT_BUDGET" not in os.environ, reason="HIPO_IMPORT_BUDGET not set"
+)
+def test_import_time_budget():
+    budget = float(os.environ["HIPO_IMPORT_BUDGET"])
+    result = check_imports(budget=budget)
+    assert result["total"] <= budget, result["top"]
+
+
+def test_heavy_modules_are_detected():
+    # The check itself must catch a heavy import
+    result = check_imports("import main; import cv2")
+    assert "cv2" in result["heavy"]
+    assert len(result["errors"]) > 0
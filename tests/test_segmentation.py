@@ -0,0 +1,134 @@
+"""Equivalence of the point segmentation backends
+
+The 'contour' and 'components' backends of segment_points must find the
+same objects, and tiled point segmentation must give the same points as
+untiled. Areas of the two backends are not compared, as the contour backend
+measures the area of the contour polygon and the components backend counts
+pixels, and centroids may differ by one pixel for the same reason.
+"""
+import numpy as np
+import pytest
+
+from lib.image import point_segmentation, segment_points
+from lib.models.Roi import Roi
+
+
+def discs(shape=(300, 400), n=120, seed=0):
+    """Image with separated discs of random radius and intensity on noise"""
+
+    rng = np.random.default_rng(seed)
+    img = rng.uniform(0, 0.05, shape).astype(np.float32)
+    rows, cols = np.indices(shape)
+    centers = []
+    while len(centers) < n:
+        c = rng.uniform(8, np.array(shape) - 8)
+        if all(np.hypot(*(c - o)) > 14 for o in centers):
+            centers.append(c)
+    for c in centers:
+        r = rng.uniform(1.5, 4.5)
+        disc = (rows - c[0]) ** 2 + (cols - c[1]) ** 2 <= r**2
+        img[disc] = rng.uniform(0.5, 1.0)
+    return img
+
+
+def mask(shape=(300, 400)):
+    m = np.zeros(shape, dtype=bool)
+    m[20:280, 30:370] = True
+    return m
+
+
+def sort_points(points):
+    return np.sort(points, order=["axis-0", "axis-1"])
+
+
+def match(contour, components):
+    """Indices of the contour and component points within one pixel"""
+
+    a = np.stack([contour["axis-0"], contour["axis-1"]], axis=1)
+    b = np.stack([components["axis-0"], components["axis-1"]], axis=1)
+    dist = np.abs(a[:, None, :] - b[None, :, :]).max(axis=2)
+    return np.nonzero(dist <= 1), dist
+
+
+def assert_same_objects(contour, components, extra=0):
+    """Every contour point matches a single component within one pixel
+
+    The contour backend discards contours of zero area (single pixels and
+    one pixel wide lines), so components can have up to extra more points,
+    all of them of at most 2 pixels.
+    """
+
+    _, dist = match(contour, components)
+    assert np.all(np.sum(dist <= 1, axis=1) == 1)
+    unmatched = components[dist.min(axis=0) > 1]
+    assert len(components) - len(contour) == len(unmatched) <= extra
+    assert np.all(unmatched["area"] <= 2)
+
+
+def test_segment_points_backends():
+    foreground = (discs() > 0.25).astype(np.float32)
+    contour = segment_points(foreground, verbose=False, backend="contour")
+    components = segment_points(foreground, verbose=False, backend="components")
+    assert len(contour) > 100
+    assert_same_objects(contour, components)
+
+
+def test_segment_points_size_filter():
+    foreground = (discs() > 0.25).astype(np.float32)
+    contour_all = segment_points(foreground, verbose=False)
+    components_all = segment_points(foreground, verbose=False, backend="components")
+    (i, j), _ = match(contour_all, components_all)
+    assert len(i) == len(contour_all) == len(components_all)
+
+    size = (20, 40)
+    contour = segment_points(foreground, size=size, verbose=False)
+    components = segment_points(
+        foreground, size=size, verbose=False, backend="components"
+    )
+
+    # Every backend keeps the objects whose own area is within the bounds
+    def kept(points):
+        return (points["area"] >= size[0]) & (points["area"] <= size[1])
+
+    np.testing.assert_array_equal(
+        sort_points(contour), sort_points(contour_all[kept(contour_all)])
+    )
+    np.testing.assert_array_equal(
+        sort_points(components), sort_points(components_all[kept(components_all)])
+    )
+
+    # The contour polygon is smaller than the pixels of the same object, so
+    # the same bounds keep different objects
+    assert np.all(components_all["area"][j] > contour_all["area"][i])
+    assert np.any(kept(contour_all)[i] != kept(components_all)[j])
+
+
+@pytest.mark.parametrize("with_mask", [False, True])
+def test_point_segmentation_backends(with_mask):
+    img, m = discs(), mask() if with_mask else None
+    contour = point_segmentation(img, {"backend": "contour"}, mask=m)
+    components = point_segmentation(img, {"backend": "components"}, mask=m)
+    assert len(contour) > 50
+    # Blurred noise at the border of the image or mask can leave tiny objects
+    assert_same_objects(contour, components, extra=2)
+
+
+@pytest.mark.parametrize("backend", ["contour", "components"])
+@pytest.mark.parametrize("with_mask", [False, True])
+def test_point_segmentation_tiled(backend, with_mask):
+    img, m = discs(), mask() if with_mask else None
+    params = {"backend": backend}
+    untiled = point_segmentation(img, params, mask=m)
+    for tile in (64, 100):
+        tiled = point_segmentation(img, params, mask=m, tile=tile, workers=2)
+        np.testing.assert_array_equal(sort_points(tiled), sort_points(untiled))
+
+
+def test_point_segmentation_roi():
+    img, m = discs(), mask()
+    for backend in ("contour", "components"):
+        params = {"backend": backend}
+        np.testing.assert_array_equal(
+            sort_points(point_segmentation(img, params, mask=m)),
+            sort_points(point_segmentation(img, params, mask=Roi(m))),
+        )